@@ -1,80 +1,204 @@
 import os
 import glob
-import json
+import shutil
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
-import pandas as pd
+from tqdm import tqdm
+
+from utils import json_io
+from utils.shards import load_shard_index
+from utils.image_validation import image_file_name
+
+
+# output extensions written as a folder of columnar files, one or more per metadata file, and their pyarrow format
+COLUMNAR_FORMATS = {".parquet": "parquet", ".arrow": "ipc", ".feather": "feather"}
+# output extensions built in memory
+ROW_FORMATS = [".json", ".csv", ".h5", ".hdf5"]
 
 
 def get_args():
     parser = argparse.ArgumentParser(description="Aggregate metadata files.")
     parser.add_argument("--meta_folder", type=str, help="Path to the folder containing metadata (JSON files with image URLs and captions)")
-    parser.add_argument("--output_file", type=str, help="Path to the output file")
+    parser.add_argument("--output_file", type=str, help="Path to the output file, .json, .csv, .h5, or a .parquet, .arrow or .feather dataset folder")
     parser.add_argument("--keyword_file", type=str, help="Path to the file containing keywords")
-    
+    parser.add_argument("--shard_folder", type=str, default=None, help="Folder of the tar shards, for images downloaded with --shards")
+    parser.add_argument("--partition_by", type=str, nargs="*", default=None, help="Columns of a columnar output that split it into hive partition folders, e.g. class_name")
+    parser.add_argument("--row_group_size", type=int, default=64 * 1024, help="Rows per parquet row group, the unit readers skip using its statistics")
+    parser.add_argument("--workers", type=int, default=None, help="Processes that read metadata files, defaults to the number of cpus")
+
     return parser.parse_args()
 
 
-def aggregate_meta_files(meta_folder: str, output_file: str, keyword_file: str) -> None:
-    """
-    Aggregate metadata files.
-    Args:
-    - meta_folder: str, path to the folder containing metadata (JSON files with image URLs and captions)
-    - output_file: str, path to the output file
-    """
-    class_names = json.load(open(keyword_file, "r"))
+def arrow_schema():
+    """Schema of the columnar output, class names and shards are dictionary encoded."""
+    import pyarrow as pa
+    return pa.schema([
+        ("uuid", pa.string()),
+        ("url", pa.string()),
+        ("caption", pa.string()),
+        ("class_id", pa.int32()),
+        ("class_name", pa.dictionary(pa.int32(), pa.string())),
+        ("image_name", pa.string()),
+        ("abs_path", pa.string()),
+        ("clip_score", pa.float32()),
+        ("clip_margin", pa.float32()),
+        ("delete", pa.bool_()),
+        ("shard", pa.dictionary(pa.int32(), pa.string())),
+        ("offset", pa.int64()),
+        ("size", pa.int64()),
+    ])
+
+
+def meta_file_rows(meta_file: str, class_names: list[str], meta_folder: str, shard_folder: str = None) -> list[dict]:
     """
-    Create a list of dictionaries, where each dictionary contains the metadata for a single image.
+    Create a list of dictionaries, where each dictionary contains the metadata for a single image of `meta_file`.
     The dictionary should have the following keys:
     - uuid: str, the unique identifier for the image
     - url: str, the URL of the image
     - caption: str, the caption for the image
-    - class_id: str, the class ID for the image
+    - class_id: int, the class ID for the image, its best scoring matched class once filtered, else the first one
     - class_name: str, the class name for the image
     - image_name: str, the name of the image file
     - abs_path: str, the absolute path to the image file
-    - clip_score: float, the CLIP similarity score for the image
+    - clip_score: float, the CLIP similarity score for the image, None if it was not scored
+    - clip_margin: float, the lead of the class over the best other class, None if it was not scored
+    - delete: bool, whether filtering marked the image as deleted
+    Images in tar shards have abs_path set to their shard, plus the byte offset and size of the image in it.
     """
-    
-    meta_files = glob.glob(f"{meta_folder}/*.json")
-    meta_list = []
-    for meta_file in meta_files:
-        metadata = json.load(open(meta_file, "r"))
-        for item in metadata:
-            class_id = item["class_id"]
-            class_name = class_names[class_id]
-            image_ext = os.path.splitext(item["url"])[1] or ".jpg"
-            image_name = f"{item['uuid']}{image_ext}"
+    rows = []
+    shard_indexes = {}
+    for item in json_io.load(meta_file):
+        # `class_id` holds all keywords the text matched, filter_images.py picks the best fitting one
+        class_id = item.get("clip_class", item["class_id"][0])
+        class_name = class_names[class_id]
+        shard_info = {}
+        if "shard" in item:
+            image_name = item["image"]
+            abs_path = os.path.abspath(os.path.join(shard_folder or os.path.join(meta_folder, "shards"), item["shard"]))
+            if abs_path not in shard_indexes:
+                # one sequential read of each shard index
+                shard_indexes[abs_path] = {entry["image"]: entry for entry in load_shard_index(abs_path)}
+            entry = shard_indexes[abs_path][image_name]
+            shard_info = {"shard": item["shard"], "offset": entry["offset"], "size": entry["size"]}
+        else:
+            image_name = image_file_name(item)
             abs_path = os.path.join(meta_folder, "images", image_name)
-            clip_score = item["similarity_score"]
-            meta_list.append({
-                "uuid": item["uuid"],
-                "url": item["url"],
-                "caption": item["caption"],
-                "class_id": class_id,
-                "class_name": class_name,
-                "image_name": image_name,
-                "abs_path": abs_path,
-                "clip_score": clip_score
-            })
-            
-    # Save the metadata
+        rows.append({
+            "uuid": item["uuid"],
+            "url": item["url"],
+            "caption": item["caption"],
+            "class_id": class_id,
+            "class_name": class_name,
+            "image_name": image_name,
+            "abs_path": abs_path,
+            "clip_score": item.get("clip_score"),
+            "clip_margin": item.get("clip_margin"),
+            "delete": item.get("delete", False),
+            **shard_info
+        })
+    return rows
+
+
+def write_columnar_part(meta_file: str,
+                        output_folder: str,
+                        output_format: str,
+                        class_names: list[str],
+                        meta_folder: str,
+                        shard_folder: str = None,
+                        partition_by: list[str] = None,
+                        row_group_size: int = 64 * 1024
+                        ) -> int:
+    """
+    Write the rows of one metadata file into the dataset in `output_folder`, as files named after it, so several
+    processes can write the same dataset. Returns the number of rows.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    table = pa.Table.from_pylist(meta_file_rows(meta_file, class_names, meta_folder, shard_folder), schema=arrow_schema())
+    # sorted by class and score, the statistics of each row group then cover a narrow range of both
+    table = table.sort_by([("class_id", "ascending"), ("clip_score", "descending")])
+    if table.num_rows == 0:
+        return 0
+    file_options = None
+    if output_format == "parquet":
+        file_options = ds.ParquetFileFormat().make_write_options(compression="zstd", use_dictionary=["class_name", "shard"],
+                                                                 write_statistics=True)
+    name = os.path.splitext(os.path.basename(meta_file))[0]
+    ext = next(ext for ext, columnar_format in COLUMNAR_FORMATS.items() if columnar_format == output_format)
+    ds.write_dataset(table, output_folder, format=output_format, file_options=file_options, basename_template=f"{name}-{{i}}{ext}",
+                     partitioning=partition_by or None, partitioning_flavor="hive" if partition_by else None,
+                     existing_data_behavior="overwrite_or_ignore", max_rows_per_group=row_group_size,
+                     min_rows_per_group=min(row_group_size, table.num_rows))
+    return table.num_rows
+
+
+def aggregate_meta_files(meta_folder: str,
+                         output_file: str,
+                         keyword_file: str,
+                         shard_folder: str = None,
+                         partition_by: list[str] = None,
+                         row_group_size: int = 64 * 1024,
+                         workers: int = None
+                         ) -> None:
+    """
+    Aggregate metadata files. Columnar outputs are written file by file by a pool of processes, so memory stays
+    bounded by the largest metadata file, and can be read back with filters on class or clip_score, e.g.
+    `pyarrow.dataset.dataset(output_file, partitioning="hive").to_table(filter=...)`, which skips the row groups
+    and partitions that cannot match. Json, csv and hdf5 outputs are built in memory.
+    Args:
+    - meta_folder: str, path to the folder containing metadata (JSON files with image URLs and captions)
+    - output_file: str, path to the output file, a folder for the `COLUMNAR_FORMATS`
+    - keyword_file: str, the keyword json the metadata was matched with, class ids index into it
+    - shard_folder: str, optional, folder of the tar shards of images downloaded with `--shards`
+    - partition_by: list[str], optional, columns of a columnar output that split it into hive partition folders
+    - row_group_size: int, rows per parquet row group
+    - workers: int, processes that read metadata files
+    """
+    class_names = json_io.load(keyword_file)
+    meta_files = sorted(glob.glob(f"{meta_folder}/*.json"))
     ext = os.path.splitext(output_file)[1]
+    if ext not in COLUMNAR_FORMATS and ext not in ROW_FORMATS:
+        raise ValueError(f"Output file format not supported. Please use one of {ROW_FORMATS + list(COLUMNAR_FORMATS)}.")
+
+    if ext in COLUMNAR_FORMATS:
+        # written next to the output and moved in place once complete, replacing the parts of an earlier run
+        tmp_folder = f"{output_file}.tmp"
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [executor.submit(write_columnar_part, meta_file, tmp_folder, COLUMNAR_FORMATS[ext], class_names, meta_folder,
+                                       shard_folder, partition_by, row_group_size) for meta_file in meta_files]
+            num_rows = sum(future.result() for future in tqdm(futures, desc="Aggregating metadata", total=len(futures)))
+        if os.path.isdir(output_file):
+            shutil.rmtree(output_file)
+        os.makedirs(tmp_folder, exist_ok=True)
+        os.replace(tmp_folder, output_file)
+        print(f"Wrote {num_rows} rows of {len(meta_files)} metadata files to {output_file}")
+        return
+
+    meta_list = []
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(meta_file_rows, meta_file, class_names, meta_folder, shard_folder) for meta_file in meta_files]
+        for future in tqdm(futures, desc="Aggregating metadata", total=len(futures)):
+            meta_list.extend(future.result())
+
+    # Save the metadata
     match ext:
         case ".json":
-            json.dump(meta_list, open(output_file, "w"), indent=4)
+            json_io.dump(meta_list, output_file)
         case ".csv":
+            import pandas as pd
             df = pd.DataFrame(meta_list)
             df.to_csv(output_file, index=False)
         case ".h5" | ".hdf5":
+            import pandas as pd
             df = pd.DataFrame(meta_list)
             df.to_hdf(output_file, key="metadata", mode="w")
-        case _:
-            raise ValueError("Output file format not supported. Please use .json or .csv.")
 
 
 if __name__ == "__main__":
     args = get_args()
-    
-    aggregate_meta_files(args.meta_folder, args.output_file, args.keyword_file)
-    
+
+    aggregate_meta_files(args.meta_folder, args.output_file, args.keyword_file, args.shard_folder,
+                         partition_by=args.partition_by, row_group_size=args.row_group_size, workers=args.workers)
+
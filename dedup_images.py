@@ -0,0 +1,139 @@
+import os
+import glob
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from tqdm import tqdm
+
+from utils import json_io
+from utils.shards import iter_shard
+from utils.image_validation import image_file_name
+from utils.image_hash import HASH_METHODS, find_near_duplicates, hash_pixels, load_gray
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Mark near-duplicate images in the download metadata.")
+    parser.add_argument("--meta_folder", type=str, help="Path to the folder containing the metadata written by download_cc_images.py")
+    parser.add_argument("--image_folder", type=str, default=None, help="Path to the folder containing images")
+    parser.add_argument("--shard_folder", type=str, default=None, help="Read images from the tar shards in this folder, written by download_cc_images.py --shards")
+    parser.add_argument("--method", choices=HASH_METHODS, default="phash", help="Perceptual hash of the images")
+    parser.add_argument("--max_distance", type=int, default=4, help="Images whose 64 bit hashes differ in at most this many bits are duplicates")
+    parser.add_argument("--workers", type=int, default=None, help="Processes that hash images, one metadata file at a time, defaults to the number of cpus")
+
+    return parser.parse_args()
+
+def image_pixels(item: dict) -> int:
+    """Pixels of the downloaded image before any resizing, 0 when the metadata does not tell."""
+    width = item.get("orig_width") or item.get("width") or 0
+    height = item.get("orig_height") or item.get("height") or 0
+    return width * height
+
+def hash_json_file(json_path: str, image_folder: str = None, shard_folder: str = None, method: str = "phash",
+                   batch_size: int = 4096) -> dict:
+    """
+    Hash the images of one metadata json, returns a dict of uuid -> (hash, pixels). Hashes already stored under
+    `method` in the metadata are reused, images that cannot be decoded are left out.
+    """
+    metadata = json_io.load(json_path)
+    hashes = {}
+    todo = {}
+    for item in metadata:
+        if item["uuid"] in hashes or item["uuid"] in todo:
+            continue
+        if method in item:
+            hashes[item["uuid"]] = (int(item[method], 16), image_pixels(item))
+        else:
+            todo[item["uuid"]] = item
+
+    uuids, grays = [], []
+    def flush():
+        for uuid, image_hash in zip(uuids, hash_pixels(np.stack(grays), method).tolist()):
+            hashes[uuid] = (image_hash, image_pixels(todo[uuid]))
+        uuids.clear()
+        grays.clear()
+
+    def add(uuid, source):
+        try:
+            grays.append(load_gray(source, method))
+            uuids.append(uuid)
+        except Exception:
+            return
+        if len(grays) >= batch_size:
+            flush()
+
+    if shard_folder is not None:
+        for shard in sorted({item["shard"] for item in todo.values() if "shard" in item}):
+            for key, sample in iter_shard(os.path.join(shard_folder, shard)):
+                if key in todo:
+                    add(key, next(data for ext, data in sample.items() if ext != ".json"))
+    else:
+        for uuid, item in todo.items():
+            image_path = os.path.join(image_folder, image_file_name(item))
+            if os.path.exists(image_path):
+                add(uuid, image_path)
+    if grays:
+        flush()
+    return hashes
+
+def mark_duplicates(json_path: str, method: str, hashes: dict, duplicate_of: dict) -> None:
+    """Store the hashes and the uuid of the copy kept for every duplicate, replacing marks of earlier runs."""
+    metadata = json_io.load(json_path)
+    for item in metadata:
+        item.pop("duplicate_of", None)
+        if item["uuid"] in hashes:
+            item[method] = f"{hashes[item['uuid']][0]:016x}"
+        if item["uuid"] in duplicate_of:
+            item["duplicate_of"] = duplicate_of[item["uuid"]]
+    json_io.dump(metadata, f"{json_path}.tmp")
+    os.replace(f"{json_path}.tmp", json_path)
+
+def dedup_images(meta_folder: str,
+                 image_folder: str = None,
+                 shard_folder: str = None,
+                 method: str = "phash",
+                 max_distance: int = 4,
+                 workers: int = None
+                 ) -> None:
+    """
+    Find near-duplicate images across all metadata files, e.g. the same photo under many CDN urls, and mark every
+    copy but one with `duplicate_of`, the uuid of the kept copy, which has the most pixels of its group.
+    `filter_images.py` skips marked images. Run again after downloading more files, the groups are rebuilt
+    over all images and only new images are hashed.
+    Args:
+    - meta_folder: str, path to the folder containing the metadata written by download_cc_images.py
+    - image_folder: str, path to the folder containing images
+    - shard_folder: str, optional, read images from tar shards instead of `image_folder`
+    - method: str, "phash" or "dhash", perceptual hash of the images
+    - max_distance: int, images whose hashes differ in at most this many bits are duplicates
+    - workers: int, processes that hash images, one metadata file at a time
+    """
+    json_files = sorted(glob.glob(f"{meta_folder}/*.json"))
+    file_hashes = []
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(hash_json_file, json_file, image_folder, shard_folder, method) for json_file in json_files]
+        for future in tqdm(futures, desc="Hashing images", total=len(futures)):
+            file_hashes.append(future.result())
+
+    # one entry per image, an image matched in several files is the same download
+    all_hashes = {}
+    for hashes in file_hashes:
+        all_hashes.update(hashes)
+    uuids = list(all_hashes)
+    values = np.fromiter((value[0] for value in all_hashes.values()), dtype=np.uint64, count=len(uuids))
+    pixels = np.fromiter((value[1] for value in all_hashes.values()), dtype=np.float64, count=len(uuids))
+    kept = find_near_duplicates(values, max_distance, priority=pixels)
+    duplicate_of = {uuids[index]: uuids[kept_index] for index, kept_index in enumerate(kept.tolist()) if kept_index != index}
+    print(f"Found {len(duplicate_of)} duplicates of {len(set(duplicate_of.values()))} images among {len(uuids)} hashed images.")
+
+    for json_file, hashes in tqdm(zip(json_files, file_hashes), desc="Marking duplicates", total=len(json_files)):
+        mark_duplicates(json_file, method, hashes, duplicate_of)
+
+if __name__ == "__main__":
+    args = get_args()
+
+    dedup_images(meta_folder=args.meta_folder,
+                 image_folder=args.image_folder,
+                 shard_folder=args.shard_folder,
+                 method=args.method,
+                 max_distance=args.max_distance,
+                 workers=args.workers)
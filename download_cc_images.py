@@ -1,64 +1,129 @@
 import os
-import json
-import requests
+import time
 import argparse
+import contextlib
 from pathlib import Path
-from urllib.parse import urlparse
-import concurrent
+from collections import Counter, defaultdict
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import pandas as pd
 from tqdm import tqdm
 
-def download_image_for_item(item, output_folder, verbose=False):
-    uuid = item["uuid"]
-    url = item["url"]
+from utils import json_io
+from utils.async_download import download_files
+from utils.image_validation import FORMAT_EXTENSIONS, IMAGE_FORMATS, ImageValidator, extract_extension, image_file_name
+from utils.shards import ShardWriter
+from utils.image_resize import ENCODE_FORMATS, ImageResizer
+from utils.download_ledger import DownloadLedger
+
+def item_result(item, info):
+    caption, class_id = None, None
     if len(item["texts"][0]) >= 3:
         caption = item["texts"][0][1]
         class_id = item["texts"][0][2]
-    ext = extract_extension(url)
-    output_path = os.path.join(output_folder, f"{uuid}{ext}")
-    # if image already exists, skip
-    if os.path.exists(output_path):
-        if verbose:
-            print(f"Image already exists: {output_path}")
-        return (uuid, url, caption, class_id)
-    return (uuid, url, caption, class_id) if download_image(url, output_path, verbose) else None
-
-def process_json_file(json_path, output_folder, workers=4, verbose=False):
-    with open(json_path, 'r') as file:
-        data = json.load(file)
-
-    results = []
-    with ProcessPoolExecutor(max_workers=workers) as executor:
-        # Submit a task for each item
-        futures = [executor.submit(download_image_for_item, item, output_folder, verbose) for item in data]
-        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc=f"Downloading images from {os.path.basename(json_path)}"):
-            if result := future.result():
-                results.append(result)
+    return (item["uuid"], item["url"], caption, class_id, info)
+
+def image_output_path(item, output_folder, ext=None):
+    return os.path.join(output_folder, image_file_name(item, ext))
+
+def shard_sink(writer, items_by_key):
+    """Appends every downloaded image with its sample json to the shards of `writer`."""
+    def sink(key, data, info):
+        item = items_by_key[key]
+        ext = FORMAT_EXTENSIONS.get(info.get("format")) or extract_extension(item["url"])
+        uuid, url, caption, class_id, _ = item_result(item, info)
+        shard = writer.write(uuid, ext, data, {"uuid": uuid, "url": url, "caption": caption, "class_id": class_id, **info})
+        return {**info, "shard": shard, "image": f"{uuid}{ext}"}
+    return sink
 
+def process_json_file(json_path, output_folder, concurrency=512, per_host=8, host_rate=None, timeout=5, validator=None,
+                      shard_folder=None, shard_size=10000, resizer=None, resize_workers=None, ledger_kwargs=None, verbose=False):
+    """
+    Download the images of one match json with the async engine, returns the downloaded items.
+    With a `validator` only images of an accepted format, size and dimensions are kept.
+    With a `shard_folder` the images are written to tar shards `<json name>-NNNNNN.tar` of `shard_size` images
+    instead of one file each.
+    With a `resizer` every image is shrunk and re-encoded in a pool of `resize_workers` processes before it is stored.
+    With `ledger_kwargs` the outcome of every download is recorded in a `DownloadLedger`, and a file that was
+    interrupted resumes from it.
+    """
+    data = json_io.load(json_path)
+
+    start = time.time()
+    stats = Counter()
+    download_kwargs = dict(concurrency=concurrency, per_host=per_host, host_rate=host_rate, timeout=timeout,
+                           validator=validator, stats=stats, verbose=verbose)
+    with contextlib.ExitStack() as stack:
+        if resizer is not None:
+            download_kwargs.update(transform=resizer, transform_executor=stack.enter_context(ProcessPoolExecutor(resize_workers)))
+        ledger = stack.enter_context(contextlib.closing(DownloadLedger(**ledger_kwargs))) if ledger_kwargs else None
+        # resized images are all re-encoded to one format, files are named after it
+        image_ext = FORMAT_EXTENSIONS[resizer.encode_format] if resizer is not None else None
+        downloaded = download_json_items(data, json_path, output_folder, shard_folder, shard_size, download_kwargs, ledger, image_ext)
+    results = [item_result(item, info) for item, info in zip(data, downloaded) if info is not None]
+    elapsed = time.time() - start
+    print(f"Downloaded {len(results)} of {len(data)} images from {os.path.basename(json_path)} in {elapsed:.2f} seconds "
+          f"({len(results) / max(elapsed, 1e-6):.1f} images/s), outcomes: {dict(stats.most_common())}.")
     return results
 
-def download_image(image_url: str, output_path: str, verbose: bool = False, timeout: int = 5):
-    try:
-        response = requests.get(image_url, stream=True, timeout=timeout)
-        if response.status_code == 200:
-            with open(output_path, 'wb') as out_file:
-                for chunk in response.iter_content(1024):
-                    out_file.write(chunk)
-            return True
-    except requests.exceptions.Timeout:
-        if verbose:
-            print(f"Request timed out for {image_url}")
-    except Exception as e:
-        if verbose:
-            print(f"Error downloading {image_url}: {e}")
-    return False
-
-def extract_extension(url):
-    parsed_url = urlparse(url)
-    root, ext = os.path.splitext(parsed_url.path)
-    return ext or '.jpg'  # Default to .jpg if no extension found
+def download_json_items(data, json_path, output_folder, shard_folder, shard_size, download_kwargs, ledger=None, image_ext=None):
+    """
+    Returns the info of every item of `data`, None for those that were not downloaded. The info of an image file
+    has its name as `image`, with the extension `image_ext` when given, else that of its url.
+    With a `ledger` images it records as downloaded are not requested again, nor are rejected ones and failed ones
+    that are not due for a retry, and the outcome of every request is recorded. Images in shards are recorded
+    once their shard is complete, so an interrupted run never points to a shard that was not written.
+    """
+    source = os.path.basename(json_path)
+    known = ledger.lookup([item["uuid"] for item in data]) if ledger is not None else {}
+    now = time.time()
+    downloaded = [None] * len(data)
+    todo = []
+    reused = 0
+    for index, item in enumerate(data):
+        row = known.get(item["uuid"])
+        if row is not None and row["status"] == "ok" and ("shard" in row["info"]) == (shard_folder is not None):
+            downloaded[index] = row["info"]
+            reused += 1
+        elif row is None or row["status"] == "ok" or ledger.is_due(row, now):
+            todo.append(index)
+    if shard_folder is None:
+        jobs = [(data[index]["url"], image_output_path(data[index], output_folder, image_ext)) for index in todo]
+    else:
+        jobs = [(data[index]["url"], data[index]["uuid"]) for index in todo]
+
+    shard_outcomes = defaultdict(list)
+
+    def on_outcome(job_index, outcome, info):
+        if info is not None and shard_folder is None:
+            # readers take the file name from the metadata, resized images have the extension of their new format
+            info["image"] = os.path.basename(jobs[job_index][1])
+        if ledger is None:
+            return
+        item = data[todo[job_index]]
+        if info is not None and "shard" in info:
+            shard_outcomes[info["shard"]].append((item["uuid"], item["url"], source, outcome, info))
+        else:
+            ledger.record(item["uuid"], item["url"], source, outcome, info)
+
+    def on_close(shard):
+        for record in shard_outcomes.pop(shard, []):
+            ledger.record(*record)
+
+    with tqdm(total=len(set(key for _, key in jobs)), desc=f"Downloading images from {source}") as progress:
+        if shard_folder is None:
+            results = download_files(jobs, on_outcome=on_outcome, progress=progress, **download_kwargs)
+        else:
+            prefix = os.path.splitext(source)[0]
+            with ShardWriter(shard_folder, prefix, max_count=shard_size, resume=ledger is not None, on_close=on_close) as writer:
+                sink = shard_sink(writer, {item["uuid"]: item for item in data})
+                results = download_files(jobs, sink=sink, on_outcome=on_outcome, progress=progress, **download_kwargs)
+    for index, info in zip(todo, results):
+        downloaded[index] = info
+    if len(todo) < len(data):
+        print(f"Download ledger: {reused} images of {source} were downloaded by an earlier run, "
+              f"{len(data) - len(todo) - reused} are skipped as rejected or waiting for a retry.")
+    return downloaded
 
 def create_metadata_file(results: dict, output_path: str, clas_list: list):
     return [
@@ -67,40 +132,102 @@ def create_metadata_file(results: dict, output_path: str, clas_list: list):
             "url": item[1],
             "caption": item[2],
             "class_id": item[3],
+            # real format, dimensions and size of the downloaded file
+            **item[4],
         }
         for item in results
     ]
 
-def process_all_json_files(folder_path: str, output_folder: str, meta_output_folder: str, class_list: list[str], workers: int = 25):
-    total_images = 0
-    for file_name in tqdm(os.listdir(folder_path), desc="Overall progress", total=len(os.listdir(folder_path))):
+def process_and_save_json_file(json_path: str, output_folder: str, output_meta_path: str, class_list: list[str], download_kwargs: dict):
+    results = process_json_file(json_path, output_folder, **download_kwargs)
+    meta_file = create_metadata_file(results, output_meta_path, class_list)
+    json_io.dump(meta_file, output_meta_path)
+    return len(results)
+
+def process_all_json_files(folder_path: str, output_folder: str, meta_output_folder: str, class_list: list[str], workers: int = 1, **download_kwargs):
+    """
+    Download the images of every match json in `folder_path`.
+    Args:
+    - workers: int, processes that each download one json file at a time with their own event loop
+    - download_kwargs: keyword arguments of `process_json_file`, e.g. concurrency, validator or shard_folder
+    """
+    todo = []
+    for file_name in sorted(os.listdir(folder_path)):
         if file_name.endswith('.json'):
             json_path = os.path.join(folder_path, file_name)
             output_meta_path = os.path.join(meta_output_folder, f"{file_name.replace('.json', '_metadata.json')}")
             # if meta already exist, skip
             if os.path.exists(output_meta_path):
                 continue
-            results = process_json_file(json_path, output_folder, workers=workers)
-            meta_file = create_metadata_file(results, meta_output_folder, class_list)
-            json.dump(meta_file, open(output_meta_path, 'w'), indent=4)
-            total_images += len(results)
-    print(f"Total images downloaded: {total_images}")
+            todo.append((json_path, output_meta_path))
+
+    total_images = 0
+    start = time.time()
+    if workers <= 1:
+        for json_path, output_meta_path in tqdm(todo, desc="Overall progress"):
+            total_images += process_and_save_json_file(json_path, output_folder, output_meta_path, class_list, download_kwargs)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(process_and_save_json_file, json_path, output_folder, output_meta_path, class_list, download_kwargs)
+                       for json_path, output_meta_path in todo]
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Overall progress"):
+                total_images += future.result()
+    print(f"Total images downloaded: {total_images} in {time.time() - start:.2f} seconds.")
+    if download_kwargs.get("ledger_kwargs"):
+        with contextlib.closing(DownloadLedger(**download_kwargs["ledger_kwargs"])) as ledger:
+            print(f"Download ledger: {ledger.summary()}")
 
 def get_args():
     parser = argparse.ArgumentParser(description="Download images from a JSON file")
     parser.add_argument("--meta_folder", help="Path to the folder containing JSON files")
     parser.add_argument("--output_folder", help="Path to the folder where images will be saved")
-    parser.add_argument("--workers", type=int, default=25, help="Number of workers for parallel processing")
+    parser.add_argument("--workers", type=int, default=1, help="Number of download processes, each works on one json file at a time")
+    parser.add_argument("--concurrency", type=int, default=512, help="Number of requests in flight per process")
+    parser.add_argument("--per_host", type=int, default=8, help="Number of requests in flight to the same host")
+    parser.add_argument("--host_rate", type=float, default=None, help="Requests started per second and host, unlimited by default")
+    parser.add_argument("--max_bytes", type=int, default=20 * 2 ** 20, help="Larger images are aborted while downloading")
+    parser.add_argument("--max_pixels", type=int, default=50000000, help="Images with more pixels are rejected from their header")
+    parser.add_argument("--formats", type=str, nargs="+", default=IMAGE_FORMATS, help="Accepted image formats, told from the file content")
+    parser.add_argument("--verify_decode", action="store_true", help="Decode every downloaded image once and drop those that fail")
+    parser.add_argument("--shards", action="store_true", help="Write images into tar shards under <output_folder>/shards instead of one file each")
+    parser.add_argument("--shard_size", type=int, default=10000, help="Images per tar shard")
+    parser.add_argument("--max_side", type=int, default=0, help="Shrink images to at most this many pixels on their longer side and re-encode them, 0 keeps the originals")
+    parser.add_argument("--encode_format", choices=ENCODE_FORMATS, default="jpeg", help="Format of resized images")
+    parser.add_argument("--quality", type=int, default=90, help="Encoder quality of resized images")
+    parser.add_argument("--resize_workers", type=int, default=None, help="Processes that resize images, defaults to the number of cpus")
+    parser.add_argument("--ledger_path", type=str, default=None, help="SQLite download ledger used to resume and to retry failed downloads, defaults to <output_folder>/_downloads.sqlite")
+    parser.add_argument("--no_ledger", action="store_true", help="Do not record downloads, an interrupted json file starts over")
+    parser.add_argument("--max_attempts", type=int, default=3, help="Total attempts, the first included, of a download that times out or fails with a server error")
+    parser.add_argument("--retry_backoff", type=float, default=600, help="Seconds before the first retry of a failed download, doubled for every further retry")
+    parser.add_argument("--timeout", type=float, default=5, help="Seconds to connect and between reads of an image request")
     parser.add_argument("--keyword_json", type=str, default="/home/lab/datasets/cc_dogs/query_keywords.json", help="Path to the metadata file")
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = get_args()
     
-    class_list = json.load(open(args.keyword_json, 'r'))
+    class_list = json_io.load(args.keyword_json)
     images_folder = os.path.join(args.output_folder, "images")
     meta_folder = os.path.join(args.output_folder, "metadata")
-    os.makedirs(images_folder, exist_ok=True)
+    if not args.shards:
+        os.makedirs(images_folder, exist_ok=True)
     os.makedirs(meta_folder, exist_ok=True)
     
-    process_all_json_files(args.meta_folder, images_folder, meta_folder, class_list)
\ No newline at end of file
+    process_all_json_files(args.meta_folder, images_folder, meta_folder, class_list,
+                           workers=args.workers,
+                           concurrency=args.concurrency,
+                           per_host=args.per_host,
+                           host_rate=args.host_rate,
+                           timeout=args.timeout,
+                           validator=ImageValidator(max_bytes=args.max_bytes,
+                                                    max_pixels=args.max_pixels,
+                                                    formats=args.formats,
+                                                    verify_decode=args.verify_decode),
+                           shard_folder=os.path.join(args.output_folder, "shards") if args.shards else None,
+                           shard_size=args.shard_size,
+                           resizer=ImageResizer(args.max_side, args.encode_format, args.quality) if args.max_side > 0 else None,
+                           resize_workers=args.resize_workers,
+                           ledger_kwargs=None if args.no_ledger else dict(
+                               path=args.ledger_path or os.path.join(args.output_folder, "_downloads.sqlite"),
+                               max_attempts=args.max_attempts,
+                               backoff=args.retry_backoff))
\ No newline at end of file
@@ -1,12 +1,15 @@
 import os
 import glob
-import json
 import argparse
+import itertools
+from collections import Counter
 
 import clip
-from tqdm import tqdm
+import numpy as np
 
-from utils.clip_filtering import get_clip_scores
+from utils import json_io
+from utils.clip_filtering import DECODERS, PRECISIONS, auto_batch_size, configure_threads, encode_classes, image_path, prepare_model, score_json_files
+from utils.embedding_cache import EmbeddingCache
 
 def get_args():
     parser = argparse.ArgumentParser(description="Filter images based on CLIP.")
@@ -16,7 +19,21 @@ def get_args():
     parser.add_argument("--device", type=str, default="cuda:0", help="Device to use for CLIP")
     parser.add_argument("--output_folder", type=str, help="Path to the folder where filtered meta will be saved")
     parser.add_argument("--threshold", type=float, default=27.5, help="Threshold for similarity score, for ViT-B/32, suggested values are between 27 and 30")
+    parser.add_argument("--class_thresholds", type=str, default=None, help="Path to a json of class name -> threshold, for classes that need another threshold than --threshold")
+    parser.add_argument("--prompt_templates", type=str, default=None, help="Path to a json list of prompts like \"a photo of a {}.\", the classes are encoded with, defaults to a built-in set")
+    parser.add_argument("--top_k", type=int, default=5, help="Best classes stored for every image")
     parser.add_argument("--delete_images", action="store_true", help="Delete images that are under the threshold")
+    parser.add_argument("--shard_folder", type=str, default=None, help="Read images from the tar shards in this folder, written by download_cc_images.py --shards")
+    parser.add_argument("--keyword_json", type=str, help="Path to the keyword json, every keyword is a class the images are scored against")
+    parser.add_argument("--cache_folder", type=str, default=None, help="Folder of the image embedding cache, defaults to <meta_folder>/_embeddings")
+    parser.add_argument("--no_cache", action="store_true", help="Encode every image again instead of using the embedding cache")
+    parser.add_argument("--batch_size", type=int, default=256, help="Images per forward pass, 0 picks the largest that fits in the available memory")
+    parser.add_argument("--num_workers", type=int, default=12, help="DataLoader processes that decode images")
+    parser.add_argument("--prefetch_factor", type=int, default=4, help="Batches each DataLoader process decodes ahead")
+    parser.add_argument("--decoder", choices=DECODERS, default="pil", help="Decode with PIL, JPEGs at a reduced scale, or with torchvision.io (libjpeg-turbo)")
+    parser.add_argument("--precision", choices=PRECISIONS, default="fp32", help="Image encoding under bf16 autocast, or with the visual tower quantized to int8 (cpu only)")
+    parser.add_argument("--threads", type=int, default=None, help="Threads within a cpu op, defaults to torch's choice")
+    parser.add_argument("--interop_threads", type=int, default=None, help="Threads that run independent cpu ops in parallel")
     
     return parser.parse_args()
 
@@ -26,10 +43,24 @@ def filter_images_with_clip(model_name: str,
                             output_folder: str,
                             device: str = "cuda:0",
                             threshold: float = 27.5,
-                            delete_images: bool = False
+                            delete_images: bool = False,
+                            shard_folder: str = None,
+                            keywords: list[str] = None,
+                            class_thresholds: dict = None,
+                            templates: list[str] = None,
+                            top_k: int = 5,
+                            cache_folder: str = None,
+                            batch_size: int = 256,
+                            num_workers: int = 12,
+                            prefetch_factor: int = 4,
+                            decoder: str = "pil",
+                            precision: str = "fp32",
+                            threads: int = None,
+                            interop_threads: int = None
                             ) -> None:
     """
-    Filter images based on CLIP similarity score.
+    Filter images based on CLIP similarity score. Every image is scored against all keywords, one class each,
+    and kept when the score of its best matched class reaches the threshold of that class.
     Args:
     - model_name: str, name of the CLIP model
     - image_folder: str, path to the folder containing images
@@ -38,27 +69,67 @@ def filter_images_with_clip(model_name: str,
     - device: str, device to use for CLIP
     - threshold: float, threshold for similarity score, for ViT-B/32, suggested values are between 27 and 30
     - delete_images: bool, delete images that are under the threshold
+    - shard_folder: str, optional, read images from tar shards, images in shards are marked as deleted instead of removed
+    - keywords: list[str], the keyword json the metadata was matched with, the class ids of the items index into it
+    - class_thresholds: dict, optional, class name -> threshold, overrides `threshold` for these classes
+    - templates: list[str], optional, prompts the classes are encoded with, see `PROMPT_TEMPLATES`
+    - top_k: int, best classes stored for every image with their scores
+    - cache_folder: str, optional, folder of an `EmbeddingCache`, images encoded by earlier runs are only rescored
+    - batch_size: int, images per forward pass, 0 picks the largest that fits in the available memory
+    - num_workers: int, DataLoader processes that decode images, started once for all files
+    - prefetch_factor: int, batches each DataLoader process decodes ahead
+    - decoder: str, "pil" or "torchvision", images that are missing or cannot be decoded are skipped and marked as deleted
+    - precision: str, "fp32", "bf16" autocast or "int8" dynamic quantization of the visual tower on cpu
+    - threads: int, optional, threads within a cpu op
+    - interop_threads: int, optional, threads that run independent cpu ops in parallel
     """
+    configure_threads(threads, interop_threads)
     
     # Load the model
     model, preprocess = clip.load(model_name, device)
+    # the classes are the same for every file, encode them once
+    class_features = encode_classes(model, keywords, device, templates)
+    thresholds = np.full(len(keywords), threshold)
+    for class_name, class_threshold in (class_thresholds or {}).items():
+        thresholds[keywords.index(class_name)] = class_threshold
+    model = prepare_model(model, device, precision)
+    if batch_size <= 0:
+        batch_size = auto_batch_size(model, preprocess, device, precision)
+    stats = Counter()
+    # bf16 and int8 embeddings differ from fp32 ones, each precision has its own cache
+    cache = EmbeddingCache(cache_folder, f"{model_name}-{precision}") if cache_folder is not None else None
 
-    # Get the list of JSON files
-    json_files = glob.glob(f"{meta_folder}/*.json")
-    
-    for json_file in tqdm(json_files, desc="Filtering images", total=len(json_files)):
-        new_meta = []
-        metadata = get_clip_scores(model, preprocess, json_file, image_folder, device)
+    def write_filtered(json_file, metadata):
         for item in metadata:
-            if item["similarity_score"] < threshold:
-                if delete_images:
-                    os.remove(item["image_path"])
-                else:
-                    item["delete"] = True
-            new_meta.append(item)
+            if "clip_score" not in item:
+                # near-duplicate of a kept image, marked by dedup_images.py, or the image could not be loaded
+                item["delete"] = True
+        scored = [item for item in metadata if "clip_score" in item]
+        # all scores of the file against the thresholds of their classes at once
+        scores = np.fromiter((item["clip_score"] for item in scored), dtype=np.float64, count=len(scored))
+        classes = np.fromiter((item["clip_class"] for item in scored), dtype=np.int64, count=len(scored))
+        for item in itertools.compress(scored, scores < thresholds[classes]):
+            if delete_images and shard_folder is None:
+                # an image matched in several files is removed with the first of them
+                if os.path.exists(image_path(item, image_folder)):
+                    os.remove(image_path(item, image_folder))
+            else:
+                item["delete"] = True
         # Save the new metadata
         output_file = os.path.join(output_folder, os.path.basename(json_file))
-        json.dump(new_meta, open(output_file, "w"), indent=4)
+        json_io.dump(metadata, output_file)
+
+    # Get the list of JSON files
+    json_files = sorted(glob.glob(f"{meta_folder}/*.json"))
+    # one pass over the images of all files, each file is written as soon as its images are scored
+    score_json_files(model, preprocess, class_features, image_folder, json_files, write_filtered, device, shard_folder=shard_folder, cache=cache,
+                     top_k=top_k, batch_size=batch_size, num_workers=num_workers, prefetch_factor=prefetch_factor, precision=precision, decoder=decoder, stats=stats)
+    if cache is not None:
+        cache.close()
+    print(f"Encoded {stats['encoded']} images in {stats['seconds']:.1f} seconds ({stats['encoded'] / max(stats['seconds'], 1e-6):.1f} images/s), "
+          f"{stats['cached']} were taken from the embedding cache.")
+    if stats["missing"] or stats["failed"]:
+        print(f"Skipped {stats['missing']} missing images and {stats['failed']} images that could not be decoded.")
 
 if __name__ == "__main__":
     args = get_args()
@@ -70,4 +141,17 @@ if __name__ == "__main__":
                             output_folder=args.output_folder,
                             device=args.device,
                             threshold=args.threshold,
-                            delete_images=args.delete_images)
\ No newline at end of file
+                            delete_images=args.delete_images,
+                            shard_folder=args.shard_folder,
+                            keywords=json_io.load(args.keyword_json),
+                            class_thresholds=json_io.load(args.class_thresholds) if args.class_thresholds else None,
+                            templates=json_io.load(args.prompt_templates) if args.prompt_templates else None,
+                            top_k=args.top_k,
+                            cache_folder=None if args.no_cache else args.cache_folder or os.path.join(args.meta_folder, "_embeddings"),
+                            batch_size=args.batch_size,
+                            num_workers=args.num_workers,
+                            prefetch_factor=args.prefetch_factor,
+                            decoder=args.decoder,
+                            precision=args.precision,
+                            threads=args.threads,
+                            interop_threads=args.interop_threads)
\ No newline at end of file
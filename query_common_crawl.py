@@ -1,63 +1,36 @@
 import os
-import json
+import time
 import argparse
 
 import boto3
-from utils.cc_matching import process
+from utils.cc_matching import ID_HASHES, process, create_match_pool
+from utils.cc_pipeline import archive_output_file, download_archive, run_pipeline, run_streaming_pipeline
+from utils.cc_listing import LISTING_SOURCES, list_cc_files
+from utils.cc_stream import open_cc_stream
+from utils.work_manifest import WorkManifest, parse_shard, shard_uris
+from utils.substr_matching import MATCH_BACKENDS, build_keyword_index, load_keyword_prefilter
+from utils.url_dedup import DEDUP_BACKENDS, open_dedup_store
 
-def list_all_wat_files(bucket: str, archive_prefix: str, save_uri_to_json: bool = False, json_path: str = None):
-    s3 = boto3.client('s3')
-    segments_prefix = f'crawl-data/{archive_prefix}/segments/'
-    wat_files_uris = []
-
-    # List all segments
-    segments_response = s3.list_objects_v2(Bucket=bucket, Prefix=segments_prefix, Delimiter='/')
-    if 'CommonPrefixes' not in segments_response:
-        print("No segments found.")
-        return
-
-    for segment in segments_response['CommonPrefixes']:
-        segment_prefix = segment['Prefix']
-        wat_prefix = f'{segment_prefix}wat/'
-
-        # Recursively list all .wat files in each segment's wat folder
-        wat_files_response = s3.list_objects_v2(Bucket=bucket, Prefix=wat_prefix)
-        while wat_files_response:
-            if 'Contents' in wat_files_response:
-                for item in wat_files_response['Contents']:
-                    # Construct the full S3 URI for each .wat.gz file
-                    wat_file_uri = f's3://{bucket}/{item["Key"]}'
-                    wat_files_uris.append(wat_file_uri)
-
-            if wat_files_response['IsTruncated']:
-                wat_files_response = s3.list_objects_v2(Bucket=bucket, Prefix=wat_prefix, ContinuationToken=wat_files_response['NextContinuationToken'])
-            else:
-                break
-            
+def list_all_wat_files(bucket: str, archive_prefix: str, save_uri_to_json: bool = False, json_path: str = None, file_format: str = 'wat', source: str = 's3', threads: int = 32):
+    files = list_cc_files(boto3.client('s3'), bucket, archive_prefix, file_format,
+                          json_path=json_path if save_uri_to_json else None,
+                          source=source, threads=threads, refresh=True)
     if not save_uri_to_json:
-        return wat_files_uris
-    
-    output_folder = os.path.dirname(json_path)
-    os.makedirs(output_folder, exist_ok=True)
-    with open(json_path, 'w') as f:
-        json.dump(wat_files_uris, f, indent=4)
+        return [item['uri'] for item in files]
 
-def process_cc_archive(data_uri: str, folder: str, s3_client: boto3.client, metadata: str, temp_folder: str = 'temp_data/cc/temp_file/', bucket_name: str = 'commoncrawl'):
-    os.makedirs(temp_folder, exist_ok=True)
+def process_cc_archive(data_uri: str, folder: str, s3_client: boto3.client, metadata: str, temp_folder: str = 'temp_data/cc/temp_file/', bucket_name: str = 'commoncrawl', match_backend: str = 'auto', pool=None, batch_size: int = 100000, prefilter=None, stream: bool = False, http_prefix: str = None, lid: bool = True, dedup_store=None, id_hash: str = 'uuid5'):
+    output_file = archive_output_file(data_uri, folder)
+    if stream:
+        # decode the archive while it is read from s3 (or http), no temp file
+        print(f'Streaming {data_uri}...')
+        with open_cc_stream(data_uri, s3_client, bucket_name, http_prefix) as cc_stream:
+            process(cc_stream, output_file, metadata, match_backend=match_backend, pool=pool, batch_size=batch_size, prefilter=prefilter, lid=lid, dedup_store=dedup_store, id_hash=id_hash)
+        return
     # download the file from s3
-    print(f'Downloading {data_uri} from s3...')
-    # get the prefix for s3 from the uri, e.g., remove s3://commoncrawl/
-    s3_prefix = data_uri.split('commoncrawl/')[1]
-    local_file_path = os.path.join(temp_folder, os.path.basename(data_uri))
-    # check if the file already exists
-    if os.path.exists(local_file_path):
-        print(f'{local_file_path} already exists, proceed with the existing file.')
-    else:
-        s3_client.download_file(bucket_name, s3_prefix, local_file_path)
+    local_file_path = download_archive(s3_client, data_uri, temp_folder, bucket_name)
     # process and save the output
     print(f'Processing {local_file_path}...')
-    output_file = os.path.join(folder, os.path.basename(data_uri).replace('.wat.gz', '.json'))
-    process(local_file_path, output_file, metadata)
+    process(local_file_path, output_file, metadata, match_backend=match_backend, pool=pool, batch_size=batch_size, prefilter=prefilter, lid=lid, dedup_store=dedup_store, id_hash=id_hash)
     # remove temp file
     print(f'Removing {local_file_path}...')
     os.remove(local_file_path)
@@ -72,6 +45,29 @@ def get_args():
     parser.add_argument('--bucket', type=str, default='commoncrawl', help='Bucket name')
     parser.add_argument('--num_files', type=int, default=None, help='Number of files to process')
     parser.add_argument('--format', choices=['wat', 'warc'], default='wat', help='Format of the meta files')
+    parser.add_argument('--match_backend', choices=MATCH_BACKENDS, default='auto', help='Keyword matching engine, "linear" reproduces the original scan for parity checks')
+    parser.add_argument('--match_procs', type=int, default=20, help='Number of keyword matching processes')
+    parser.add_argument('--batch_size', type=int, default=100000, help='Number of image records parsed, matched and written at a time, bounds the memory per WAT file')
+    parser.add_argument('--keyword_prefilter', action='store_true', help='Skip WAT records whose raw json contains no keyword before parsing them')
+    parser.add_argument('--no_lid', action='store_true', help='Keep matched texts of every language instead of only english ones')
+    parser.add_argument('--dedup', choices=DEDUP_BACKENDS, default='memory', help='Dedup of (url, text) pairs: exact per archive in memory, a bloom filter across the archives of a process, or a sqlite store across processes, nodes and runs')
+    parser.add_argument('--dedup_path', type=str, default=None, help='Database of the sqlite dedup store, defaults to <output_folder>/_url_dedup.sqlite')
+    parser.add_argument('--dedup_capacity', type=int, default=None, help='Number of texts the bloom filter is sized for (default 20M), or the most hashes the memory store holds')
+    parser.add_argument('--dedup_error_rate', type=float, default=0.01, help='False positive rate of the bloom filter at its capacity')
+    parser.add_argument('--id_hash', choices=ID_HASHES, default='uuid5', help='How image ids are computed from urls, "xxhash" is faster but its ids differ from uuid5 ids of earlier runs')
+    parser.add_argument('--workers', type=int, default=0, help='Number of parse and match processes in pipelined mode, 0 processes the files one after another')
+    parser.add_argument('--prefetch', type=int, default=2, help='Number of archives downloaded ahead of the workers in pipelined mode')
+    parser.add_argument('--temp_folder', type=str, default='temp_data/cc/temp_file/', help='Folder for downloaded archives, holds at most prefetch + workers files in pipelined mode')
+    parser.add_argument('--stream', action='store_true', help='Decode archives while they are read from s3 instead of downloading them to temp_folder first')
+    parser.add_argument('--http_prefix', type=str, default=None, help='With --stream, read archives over http from this prefix instead of s3, e.g. https://data.commoncrawl.org/')
+    parser.add_argument('--shard', type=str, default='0/1', help='Process only shard i of N of the archives, e.g. 3/16, the assignment is deterministic')
+    parser.add_argument('--manifest', type=str, default=None, help='SQLite work manifest shared by all nodes, defaults to <output_folder>/_work_manifest.sqlite')
+    parser.add_argument('--lease_hours', type=float, default=2, help='Hours after which an unfinished archive claimed by another node may be taken over')
+    parser.add_argument('--max_attempts', type=int, default=3, help='Number of attempts for an archive before it stays failed')
+    parser.add_argument('--listing', choices=LISTING_SOURCES, default='s3', help='List archives by paging through the bucket, or read the published <format>.paths.gz')
+    parser.add_argument('--list_threads', type=int, default=32, help='Number of segments listed concurrently')
+    parser.add_argument('--refresh_listing', action='store_true', help='List the archives again instead of using the cached listing')
+    parser.add_argument('--index_cache', type=str, default=None, help='Folder for the compiled keyword index, defaults to <archive_folder>/keyword_index')
     
     
     # AWS credientials
@@ -84,30 +80,100 @@ def get_args():
 if __name__ == '__main__':
     args = get_args()
     
-    if not os.path.exists(f'{args.archive_folder}/{args.archive}/{args.format}_file_uris.json'):
-        print(f"Getting {args.format} file uris from {args.bucket}/{args.crawl} and save to {args.archive_folder}/{args.crawl}/{args.format}_file_uris.json...")
-        list_all_wat_files(args.bucket, args.crawl, save_uri_to_json=True, json_path=f'{args.archive_folder}/{args.crawl}/{args.format}_file_uris.json')
-    # read the wat file uris
-    wat_file_uris = json.load(open(f'{args.archive_folder}/{args.crawl}/{args.format}_file_uris.json', 'r'))
-
+    s3_client_kwargs = {'region_name': 'us-east-1'}
     if args.aws_access_key_id is not None and args.aws_secret_access_key is not None:
-        s3_client = boto3.client('s3', 
-                                 region_name='us-east-1', 
-                                 aws_access_key_id=args.aws_access_key_id, 
-                                 aws_secret_access_key=args.aws_secret_access_key, 
-                                 aws_session_token=args.aws_session_token)
+        s3_client_kwargs.update(aws_access_key_id=args.aws_access_key_id,
+                                aws_secret_access_key=args.aws_secret_access_key,
+                                aws_session_token=args.aws_session_token)
+    s3_client = boto3.client('s3', **s3_client_kwargs)
+
+    # list the archives once, later runs read the cached listing
+    listing_path = f'{args.archive_folder}/{args.crawl}/{args.format}_file_uris.json'
+    cc_files = list_cc_files(s3_client, args.bucket, args.crawl, args.format,
+                             json_path=listing_path,
+                             source=args.listing,
+                             threads=args.list_threads,
+                             http_prefix=args.http_prefix,
+                             refresh=args.refresh_listing)
+    wat_file_uris = [item['uri'] for item in cc_files]
+    wat_file_uris = shard_uris(wat_file_uris, *parse_shard(args.shard))
+    print(f'Shard {args.shard}: {len(wat_file_uris)} files.')
+
+    # claims, outcomes and timings of every archive, shared by all nodes writing to the output folder
+    manifest = WorkManifest(args.manifest or os.path.join(args.output_folder, '_work_manifest.sqlite'),
+                            lease_seconds=args.lease_hours * 3600,
+                            max_attempts=args.max_attempts)
+    # outputs are renamed into place once complete, so those from earlier runs count as done
+    existing_outputs = set(os.listdir(args.output_folder)) if os.path.isdir(args.output_folder) else set()
+    manifest.add(wat_file_uris, done_uris={uri for uri in wat_file_uris
+                                           if os.path.basename(archive_output_file(uri, args.output_folder)) in existing_outputs})
+
+    # compile the keywords once per run, workers load the cached index instead of receiving the keyword list per task
+    index_cache = args.index_cache or os.path.join(args.archive_folder, 'keyword_index')
+    index_path = build_keyword_index(args.keyword_json, index_cache, args.match_backend)
+
+    dedup_kwargs = {'backend': args.dedup,
+                    'path': args.dedup_path or os.path.join(args.output_folder, '_url_dedup.sqlite'),
+                    'capacity': args.dedup_capacity,
+                    'error_rate': args.dedup_error_rate}
+
+    if args.workers > 0:
+        if args.stream:
+            run_streaming_pipeline(wat_file_uris, args.output_folder, index_path,
+                                   bucket_name=args.bucket,
+                                   workers=args.workers,
+                                   batch_size=args.batch_size,
+                                   keyword_prefilter=args.keyword_prefilter,
+                                   s3_client_kwargs=s3_client_kwargs,
+                                   http_prefix=args.http_prefix,
+                                   manifest=manifest,
+                                   max_files=args.num_files,
+                                   lid=not args.no_lid,
+                                   dedup_kwargs=dedup_kwargs,
+                                   id_hash=args.id_hash)
+        else:
+            run_pipeline(wat_file_uris, args.output_folder, s3_client, index_path,
+                         temp_folder=args.temp_folder,
+                         bucket_name=args.bucket,
+                         prefetch=args.prefetch,
+                         workers=args.workers,
+                         batch_size=args.batch_size,
+                         keyword_prefilter=args.keyword_prefilter,
+                         manifest=manifest,
+                         max_files=args.num_files,
+                         lid=not args.no_lid,
+                         dedup_kwargs=dedup_kwargs,
+                         id_hash=args.id_hash)
     else:
-        s3_client = boto3.client('s3', region_name='us-east-1')
+        match_pool = create_match_pool(index_path, args.match_procs)
+        prefilter = load_keyword_prefilter(index_path) if args.keyword_prefilter else None
+        dedup_store = open_dedup_store(**dedup_kwargs)
+
+        process_file_count = 0
+        for wat_file_uri in wat_file_uris:
+            if args.num_files is not None and process_file_count >= args.num_files:
+                print(f"Processed {args.num_files} files, stop processing.")
+                break
+            # skip archives that are done or being processed by another node
+            if not manifest.claim(wat_file_uri):
+                continue
+            start = time.time()
+            try:
+                with manifest.heartbeat([wat_file_uri], interval=min(60, args.lease_hours * 3600 / 4)):
+                    process_cc_archive(wat_file_uri, args.output_folder, s3_client, args.keyword_json, temp_folder=args.temp_folder, bucket_name=args.bucket, match_backend=args.match_backend, pool=match_pool, batch_size=args.batch_size, prefilter=prefilter, stream=args.stream, http_prefix=args.http_prefix, lid=not args.no_lid, dedup_store=dedup_store, id_hash=args.id_hash)
+            except Exception as e:
+                print(f'Failed to process {wat_file_uri}: {e}')
+                manifest.fail(wat_file_uri, e)
+                continue
+            except BaseException:
+                manifest.fail(wat_file_uri, 'interrupted')
+                raise
+            manifest.complete(wat_file_uri, time.time() - start)
+            process_file_count += 1
+
+        match_pool.close()
+        match_pool.join()
+        dedup_store.close()
 
-    process_file_count = 0
-    for wat_file_uri in wat_file_uris:
-        if args.num_files is not None and process_file_count >= args.num_files:
-            print(f"Processed {args.num_files} files, stop processing.")
-            break
-        # check if exist
-        output_file = os.path.join(args.output_folder, os.path.basename(wat_file_uri).replace('.wat.gz', '.json'))
-        if os.path.exists(output_file):
-            print(f'{output_file} already exists.')
-            continue
-        process_cc_archive(wat_file_uri, args.output_folder, s3_client, args.keyword_json)
-        process_file_count += 1
+    print(f'Manifest summary: {manifest.summary()}')
+    manifest.close()
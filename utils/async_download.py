@@ -0,0 +1,268 @@
+import io
+import os
+import time
+import asyncio
+from collections import Counter, deque
+from urllib.parse import urlparse
+
+from .image_validation import InvalidImage
+
+
+class HostLimiter(object):
+    """
+    Queues jobs per host and hands them out to whichever worker asks first, from a host that has a free slot,
+    capping the requests in flight to one host and spacing out their starts, so no site gets hammered
+    and a long run of jobs for one host never holds up the workers that could serve the others.
+    """
+
+    def __init__(self, per_host: int = 8, host_rate: float = None):
+        """
+        Args:
+        - per_host: int, concurrent requests to the same host
+        - host_rate: float, optional, requests started per second and host
+        """
+        self.per_host = per_host
+        self.interval = 1.0 / host_rate if host_rate else 0.0
+        self.pending = {}
+        self.num_pending = 0
+        self.in_flight = Counter()
+        self.next_start = {}
+        # hosts that can start a job now, and those plus the ones waiting for their next start
+        self.ready = deque()
+        self.listed = set()
+        self.wakeup = asyncio.Event()
+
+    def put(self, host: str, item) -> None:
+        self.pending.setdefault(host, deque()).append(item)
+        self.num_pending += 1
+        self._offer(host)
+
+    async def get(self):
+        """Next (host, item) with a slot of its host held until `release(host)`, None once no job is left."""
+        while not self.ready:
+            if not self.num_pending:
+                return None
+            self.wakeup.clear()
+            await self.wakeup.wait()
+        host = self.ready.popleft()
+        self.listed.discard(host)
+        item = self.pending[host].popleft()
+        if not self.pending[host]:
+            del self.pending[host]
+        self.num_pending -= 1
+        self.in_flight[host] += 1
+        if self.interval > 0:
+            self.next_start[host] = max(time.monotonic(), self.next_start.get(host, 0.0)) + self.interval
+        self._offer(host)
+        if not self.num_pending:
+            # let the idle workers finish
+            self.wakeup.set()
+        return host, item
+
+    def release(self, host: str) -> None:
+        self.in_flight[host] -= 1
+        if not self.in_flight[host]:
+            del self.in_flight[host]
+        self._offer(host)
+
+    def _offer(self, host: str) -> None:
+        """List `host` as ready once it has jobs, a free slot and its next start is due."""
+        if host in self.listed or host not in self.pending or self.in_flight[host] >= self.per_host:
+            return
+        self.listed.add(host)
+        delay = self.next_start.get(host, 0.0) - time.monotonic()
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._ready, host)
+        else:
+            self._ready(host)
+
+    def _ready(self, host: str) -> None:
+        self.ready.append(host)
+        self.wakeup.set()
+
+
+async def fetch_into(session, url: str, out_file, validator=None, chunk_size: int = 1 << 16) -> dict:
+    """
+    Stream one url into the binary file object `out_file`. Returns the size, and with a `validator`
+    the real format and dimensions, of a complete 200 response. Raises `InvalidImage` as soon as the headers
+    or the first bytes show the download is not wanted, so the rest of the body is never read.
+    """
+    async with session.get(url) as response:
+        if response.status != 200:
+            raise InvalidImage(f"http {response.status}")
+        if validator is not None:
+            validator.check_headers(response.headers.get("Content-Type"), response.content_length)
+        info = None
+        head = b""
+        num_bytes = 0
+        async for chunk in response.content.iter_chunked(chunk_size):
+            num_bytes += len(chunk)
+            if validator is not None:
+                validator.check_size(num_bytes)
+                if info is None:
+                    head += chunk
+                    info = validator.check_head(head)
+            out_file.write(chunk)
+    if validator is not None and info is None:
+        info = validator.check_head(head, complete=True)
+    info = info or {}
+    info["bytes"] = num_bytes
+    return info
+
+
+async def check_decode(validator, source) -> None:
+    if validator is not None and validator.verify_decode:
+        # decoding is cpu bound, keep it off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, validator.check_decode, source)
+
+
+async def fetch_to_file(session, url: str, output_path: str, validator=None) -> dict:
+    """Stream one url into `output_path` through a `.part` file, see `fetch_into`."""
+    part_path = f"{output_path}.part"
+    try:
+        with open(part_path, "wb") as out_file:
+            info = await fetch_into(session, url, out_file, validator)
+        await check_decode(validator, part_path)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    os.replace(part_path, output_path)
+    return info
+
+
+async def fetch_to_memory(session, url: str, validator=None) -> tuple[bytes, dict]:
+    """Download one url into memory, see `fetch_into`, e.g. to append it to a shard."""
+    buffer = io.BytesIO()
+    info = await fetch_into(session, url, buffer, validator)
+    await check_decode(validator, io.BytesIO(buffer.getvalue()))
+    return buffer.getvalue(), info
+
+
+async def download_all(jobs: list[tuple[str, str]],
+                       concurrency: int = 512,
+                       per_host: int = 8,
+                       host_rate: float = None,
+                       timeout: float = 5,
+                       validator=None,
+                       sink=None,
+                       transform=None,
+                       transform_executor=None,
+                       stats: Counter = None,
+                       on_outcome=None,
+                       progress=None,
+                       verbose: bool = False) -> list[dict]:
+    """
+    Download (url, output_path) jobs with one keep-alive connection pool. Returns the info of `fetch_into`
+    for every job that succeeded and None for the others. Existing output files count as downloaded,
+    with a `validator` they are checked again and removed when they fail.
+    With a `sink` nothing is written to disk here: jobs are (url, key) and `sink(key, data, info)` receives
+    every downloaded image and returns the info to keep, e.g. with the shard it was written to.
+    Args:
+    - concurrency: int, requests in flight in this process
+    - per_host: int, requests in flight to the same host
+    - host_rate: float, optional, requests started per second and host
+    - timeout: float, seconds to connect and between reads of the body, like the timeout of `requests`
+    - validator: ImageValidator, optional, checks type, size and dimensions while downloading
+    - sink: callable, optional, takes the downloaded images instead of files
+    - transform: callable, optional, `transform(data, info)` returns new image bytes and info before they are stored,
+      e.g. an `ImageResizer`
+    - transform_executor: Executor, optional, runs `transform`, a process pool for cpu bound transforms
+    - stats: Counter, optional, counts downloads per outcome, e.g. "ok", "http 404", "not an image"
+    - on_outcome: callable, optional, `on_outcome(index, outcome, info)` is called once per distinct output file with
+      the index of its first job, `outcome` has the "status" counted in `stats`, "http_status", "bytes" and "latency"
+      (None when unknown) and `info` is the result of the job, e.g. to record it in a `DownloadLedger`
+    - progress: tqdm, optional, updated once per distinct output file
+    """
+    import aiohttp
+
+    results = [None] * len(jobs)
+    stats = stats if stats is not None else Counter()
+    # records of one image share its output file, download it once
+    first_job = {}
+    limiter = HostLimiter(per_host, host_rate)
+    for index, (url, output_path) in enumerate(jobs):
+        if output_path not in first_job:
+            first_job[output_path] = index
+            limiter.put(urlparse(url).netloc, index)
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=per_host, ttl_dns_cache=300, enable_cleanup_closed=True)
+
+    async def worker(session):
+        while True:
+            job = await limiter.get()
+            if job is None:
+                return
+            host, index = job
+            url, output_path = jobs[index]
+            outcome = {"status": "ok", "http_status": None, "bytes": None, "latency": None}
+            try:
+                if sink is None and os.path.exists(output_path):
+                    limiter.release(host)
+                    results[index] = check_existing(output_path, validator)
+                elif sink is None and transform is None:
+                    try:
+                        start, outcome["http_status"] = time.monotonic(), 200
+                        results[index] = await fetch_to_file(session, url, output_path, validator)
+                        outcome["latency"] = time.monotonic() - start
+                    finally:
+                        limiter.release(host)
+                else:
+                    try:
+                        start, outcome["http_status"] = time.monotonic(), 200
+                        data, info = await fetch_to_memory(session, url, validator)
+                        outcome["latency"] = time.monotonic() - start
+                    finally:
+                        limiter.release(host)
+                    if transform is not None:
+                        data, info = await asyncio.get_running_loop().run_in_executor(transform_executor, transform, data, info)
+                    results[index] = sink(output_path, data, info) if sink is not None else write_file(output_path, data, info)
+                outcome["bytes"] = results[index].get("bytes")
+            except InvalidImage as e:
+                outcome["status"] = str(e)
+                # other rejections come after the status line of a 200, see `fetch_into`
+                if outcome["status"].startswith("http "):
+                    outcome["http_status"] = int(outcome["status"][5:])
+                if verbose:
+                    print(f"Rejected {url}: {e}")
+            except asyncio.TimeoutError:
+                outcome["status"], outcome["http_status"] = "timeout", None
+                if verbose:
+                    print(f"Request timed out for {url}")
+            except Exception as e:
+                outcome["status"], outcome["http_status"] = "error", None
+                if verbose:
+                    print(f"Error downloading {url}: {e}")
+            stats[outcome["status"]] += 1
+            if on_outcome is not None:
+                on_outcome(index, outcome, results[index])
+            if progress is not None:
+                progress.update(1)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)) as session:
+        await asyncio.gather(*(worker(session) for _ in range(min(concurrency, limiter.num_pending))))
+    return [results[first_job[output_path]] for _, output_path in jobs]
+
+
+def write_file(output_path: str, data: bytes, info: dict) -> dict:
+    part_path = f"{output_path}.part"
+    with open(part_path, "wb") as out_file:
+        out_file.write(data)
+    os.replace(part_path, output_path)
+    return info
+
+
+def check_existing(output_path: str, validator=None) -> dict:
+    if validator is None:
+        return {"bytes": os.path.getsize(output_path)}
+    try:
+        return validator.check_file(output_path)
+    except InvalidImage:
+        os.remove(output_path)
+        raise
+
+
+def download_files(jobs: list[tuple[str, str]], **kwargs) -> list[dict]:
+    """Blocking wrapper of `download_all` that runs its own event loop, e.g. inside a worker process."""
+    if len(jobs) == 0:
+        return []
+    return asyncio.run(download_all(jobs, **kwargs))
@@ -0,0 +1,106 @@
+import os
+import gzip
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import json_io
+
+
+LISTING_SOURCES = ["s3", "paths"]
+
+
+def list_segments(s3_client, bucket: str, crawl: str) -> list[str]:
+    """All segment prefixes of a crawl, paging past the 1000 keys of a single `list_objects_v2` call."""
+    paginator = s3_client.get_paginator('list_objects_v2')
+    segments = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=f'crawl-data/{crawl}/segments/', Delimiter='/'):
+        segments.extend(prefix['Prefix'] for prefix in page.get('CommonPrefixes', []))
+    return segments
+
+
+def list_segment_files(s3_client, bucket: str, segment_prefix: str, file_format: str = 'wat') -> list[dict]:
+    paginator = s3_client.get_paginator('list_objects_v2')
+    files = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=f'{segment_prefix}{file_format}/'):
+        for item in page.get('Contents', []):
+            files.append({
+                'uri': f's3://{bucket}/{item["Key"]}',
+                'size': item.get('Size'),
+                'etag': item.get('ETag', '').strip('"') or None,
+            })
+    return files
+
+
+def list_files_from_s3(s3_client, bucket: str, crawl: str, file_format: str = 'wat', threads: int = 32) -> list[dict]:
+    """List the archives of every segment, with segments listed concurrently on a thread pool."""
+    segments = list_segments(s3_client, bucket, crawl)
+    print(f'Found {len(segments)} segments in {bucket}/{crawl}, listing their {file_format} files with {threads} threads...')
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        per_segment = executor.map(lambda segment: list_segment_files(s3_client, bucket, segment, file_format), segments)
+        return [item for files in per_segment for item in files]
+
+
+def list_files_from_paths(s3_client, bucket: str, crawl: str, file_format: str = 'wat', http_prefix: str = None) -> list[dict]:
+    """Read the `<format>.paths.gz` file list that is published with every crawl, one request instead of a full listing."""
+    key = f'crawl-data/{crawl}/{file_format}.paths.gz'
+    if http_prefix is not None:
+        import urllib.request
+        with urllib.request.urlopen(f'{http_prefix.rstrip("/")}/{key}', timeout=120) as response:
+            data = response.read()
+    else:
+        data = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+    keys = gzip.decompress(data).decode().split()
+    # the published list does not carry sizes or etags
+    return [{'uri': f's3://{bucket}/{key}', 'size': None, 'etag': None} for key in keys]
+
+
+def load_file_manifest(json_path: str) -> list[dict]:
+    """Read a cached listing, the old plain list of uris is accepted as well."""
+    manifest = json_io.load(json_path)
+    if isinstance(manifest, list):
+        return [{'uri': uri, 'size': None, 'etag': None} for uri in manifest]
+    return manifest['files']
+
+
+def list_cc_files(s3_client,
+                  bucket: str,
+                  crawl: str,
+                  file_format: str = 'wat',
+                  json_path: str = None,
+                  source: str = 's3',
+                  threads: int = 32,
+                  http_prefix: str = None,
+                  refresh: bool = False) -> list[dict]:
+    """
+    List the archives of a crawl as dicts with uri, size and etag, cached in `json_path` so later runs start instantly.
+    Args:
+    - file_format: str, "wat" or "warc"
+    - json_path: str, optional, cache file of the listing
+    - source: str, "s3" pages through the bucket, "paths" reads the published `<format>.paths.gz`
+    - threads: int, number of segments listed concurrently
+    - refresh: bool, list again even if a cache exists
+    """
+    if json_path is not None and os.path.exists(json_path) and not refresh:
+        files = load_file_manifest(json_path)
+        print(f'Loaded {len(files)} {file_format} files from {json_path}.')
+        return files
+
+    start = time.time()
+    if source == 'paths':
+        files = list_files_from_paths(s3_client, bucket, crawl, file_format, http_prefix)
+    elif source == 's3':
+        files = list_files_from_s3(s3_client, bucket, crawl, file_format, threads)
+    else:
+        raise ValueError(f'unknown listing source {source}, expected one of {LISTING_SOURCES}')
+    files.sort(key=lambda item: item['uri'])
+    print(f'Listed {len(files)} {file_format} files from {source} in {time.time() - start:.2f} seconds.')
+
+    if json_path is not None:
+        json_io.dump({
+            'crawl': crawl,
+            'format': file_format,
+            'source': source,
+            'created': time.time(),
+            'files': files,
+        }, json_path)
+    return files
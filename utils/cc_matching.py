@@ -3,23 +3,33 @@
 
 import os
 import math
-import json
 import time
 import gzip
 import uuid
 import logging
+import signal
 import functools
+import threading
+import contextlib
+import multiprocessing
 
 from tqdm import tqdm
 from urllib.parse import urljoin
-from collections import defaultdict
-from multiprocessing import Process, Manager, Pool
-from .substr_matching import substr_matching
+from collections import deque
+from multiprocessing import Pool
+from . import json_io
+from .json_io import JsonArrayWriter
+from .lang_id import get_language_identifier
+from .substr_matching import substr_matching, load_keyword_index
+from .url_dedup import HashDedupStore, text_key
 # from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
 
+# "uuid5" ids are compatible with earlier outputs, "xxhash" ids are faster to compute but differ from them
+ID_HASHES = ["uuid5", "xxhash"]
+
 
 def timing_decorator(func):
     @functools.wraps(func)
@@ -31,19 +41,44 @@ def timing_decorator(func):
         return result
     return wrapper
 
+@functools.lru_cache(maxsize=1 << 16)
 def uuid_from_url(url: str):
-    # use url to generate uuid with uuid module
+    # use url to generate uuid with uuid module, cached since logos and icons repeat across pages
     return str(uuid.uuid5(uuid.NAMESPACE_URL, url))
 
 
+def get_id_fn(id_hash: str = "uuid5"):
+    """
+    The function that turns an image url into its id. "xxhash" ids are a 128-bit xxh3 hash in uuid format
+    with version 8 instead of 5, so they never collide with uuid5 ids of the same url.
+    """
+    if id_hash == "uuid5":
+        return uuid_from_url
+    if id_hash == "xxhash":
+        import xxhash
+
+        def xxhash_from_url(url: str):
+            h = xxhash.xxh3_128_hexdigest(url.encode("utf-8", "surrogatepass"))
+            variant = "89ab"[int(h[16], 16) & 3]
+            return f"{h[:8]}-{h[8:12]}-8{h[13:16]}-{variant}{h[17:20]}-{h[20:32]}"
+        return xxhash_from_url
+    raise ValueError(f"unknown id hash {id_hash}, expected one of {ID_HASHES}")
+
+
 def lid(text):
-    import fasttext
-    fasttext.FastText.eprint = lambda x: None
-    from ftlangdetect import detect
-    return detect(text=text, low_memory=True)["lang"]
+    return get_language_identifier().predict([text])[0]
+
 
+def create_match_pool(index_path, num_proc=20):
+    """A pool whose workers load the cached keyword index once, it can be reused across cc files."""
+    return Pool(num_proc, initializer=load_keyword_index, initargs=(index_path,))
 
-def process_data(raw_data, metadata):
+
+def process_data(raw_data, metadata=None, backend="auto", use_lid=False):
+    """
+    Keep the texts of each record that match a keyword, and with `use_lid` only the english ones among them.
+    Language identification runs after matching, so only candidate texts pay for it.
+    """
     matched_data = []
     for pair in raw_data:
         texts = []
@@ -51,7 +86,7 @@ def process_data(raw_data, metadata):
             text_key, text = key_text
             if len(text) == 0:
                 continue
-            matched_entry_ids = substr_matching(text, metadata)
+            matched_entry_ids = substr_matching(text, metadata, backend=backend)
             if len(matched_entry_ids) > 0:
                 orig_text = key_text[1]
                 texts.append([text_key, orig_text, matched_entry_ids])
@@ -59,9 +94,26 @@ def process_data(raw_data, metadata):
         if len(texts) > 0:
             pair["texts"] = texts
             matched_data.append(pair)
+
+    if use_lid:
+        matched_data = keep_english(matched_data)
     return matched_data
 
 
+def keep_english(matched_data):
+    """Keep the matched texts identified as english, records left without texts are dropped."""
+    if len(matched_data) == 0:
+        return matched_data
+    # one batched call for all candidate texts of this chunk
+    langs = iter(get_language_identifier().predict([text[1] for pair in matched_data for text in pair["texts"]]))
+    english_data = []
+    for pair in matched_data:
+        pair["texts"] = [text for text in pair["texts"] if next(langs) == "en"]
+        if len(pair["texts"]) > 0:
+            english_data.append(pair)
+    return english_data
+
+
 class CCCurator(object):
     KOI = ["alt", "title", "data-image-title"]
 
@@ -74,11 +126,17 @@ class CCCurator(object):
         raise NotImplementedError("derive this class a for specific type of parser.")
 
     @classmethod
-    def save_json(cls, fn, data):
-        from pathlib import Path
-        Path(os.path.dirname(fn)).mkdir(parents=True, exist_ok=True)
-        with open(fn, "w") as fw:
-            json.dump(data, fw, indent=1)
+    def save_json(cls, fn, data, indent=None):
+        json_io.dump(data, fn, indent=indent)
+
+    def dedup_texts(self, rec):
+        """Texts of a record that were not seen before with the same url, all of them when dedup is off."""
+        if not self.dedup:
+            return rec["texts"]
+        return [text for text in rec["texts"] if self.dedup_store.add(text_key(rec["uuid"], text[1]))]
+
+    def clean_dedup_cache(self):
+        self.dedup_store.clear()
 
     @classmethod
     def normalize_url(cls, url, target_uri, strip_param=False):
@@ -90,7 +148,16 @@ class CCCurator(object):
         except Exception:  # eg ed2k://
             return None
 
-    def substrmatch(self, data, metadata, num_proc=20):
+    def substrmatch(self, data, metadata=None, num_proc=20, backend="auto", pool=None):
+        if len(data) == 0:
+            return []
+        use_lid = getattr(self, "lid", False)
+        if getattr(self, "match_inline", False):
+            # texts were matched while parsing, only language identification is left
+            return keep_english(data) if use_lid else data
+        if pool is None and num_proc <= 1:
+            # match in this process, e.g. inside a pipeline worker
+            return process_data(data, metadata, backend, use_lid)
         pairs_per_proc = math.ceil(len(data) / num_proc)
 
         data_lists = [
@@ -98,34 +165,151 @@ class CCCurator(object):
             for start in range(0, len(data), pairs_per_proc)
         ]
 
-        entries_lists = [metadata] * len(data_lists)
-        num_proc = len(data_lists)
+        if pool is None:
+            with Pool(len(data_lists)) as p:
+                return self.substrmatch(data, metadata, num_proc, backend, pool=p)
+
+        # without metadata the workers already hold the keyword index, only the records are sent
+        match_fn = functools.partial(process_data, metadata=metadata, backend=backend, use_lid=use_lid)
 
         results = []
-        with Pool(num_proc) as p:
-            for result in tqdm(p.starmap(process_data, zip(data_lists, entries_lists)),
-                            total=len(data_lists), desc="Substr matching"):
-                results.extend(result)
+        for result in tqdm(pool.imap(match_fn, data_lists),
+                        total=len(data_lists), desc="Substr matching"):
+            results.extend(result)
 
         return results
 
 
+class PageTimeout(Exception):
+    pass
+
+
+def _raise_page_timeout(signum, frame):
+    raise PageTimeout()
+
+
+def extract_images_from_html(html, target_uri, id_hash="uuid5"):
+    """img records of one page, before url dedup and language identification."""
+    from selectolax.parser import HTMLParser
+    tree = HTMLParser(html)
+    id_from_url = get_id_fn(id_hash)
+    recs = []
+    for img_node in tree.tags("img"):
+        texts = []
+        src = None
+        for key in img_node.attrs.keys():
+            if key not in CCCurator.KOI + ["src"]:
+                continue
+
+            text = img_node.attrs[key]
+            if text is None:
+                continue
+            text = text.strip().replace("\n", "").replace("\r", "")
+            if len(text) == 0:
+                continue
+
+            if key == "src":
+                src = text
+
+            if key in CCCurator.KOI:
+                texts.append([key, text])
+
+        # images without texts would be dropped by the dedup anyway, skip their url work
+        if src is None or len(texts) == 0:
+            continue
+        url = CCCurator.normalize_url(src, target_uri)
+        if url is None:
+            continue
+        recs.append({"uuid": id_from_url(url), "url": url, "texts": texts})
+    return recs
+
+
+def parse_html_batch(htmls, page_timeout=60, id_hash="uuid5"):
+    """
+    Extract the img records of a list of (html, target_uri) pages, runs in an html worker.
+    A page that takes longer than `page_timeout` seconds or fails to parse is dropped, the rest of the batch is kept.
+    Returns the records and the number of dropped pages.
+    """
+    # SIGALRM can only be handled in the main thread of a process
+    use_alarm = bool(page_timeout) and hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread()
+    if use_alarm:
+        previous_handler = signal.signal(signal.SIGALRM, _raise_page_timeout)
+    recs, num_dropped = [], 0
+    try:
+        for html, target_uri in htmls:
+            try:
+                if use_alarm:
+                    signal.setitimer(signal.ITIMER_REAL, page_timeout)
+                page_recs = extract_images_from_html(html, target_uri, id_hash)
+                if use_alarm:
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+            except PageTimeout:
+                num_dropped += 1
+                continue
+            except Exception as e:
+                if use_alarm:
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+                print(f"failed to parse {target_uri}: {e}")
+                num_dropped += 1
+                continue
+            recs.extend(page_recs)
+    finally:
+        if use_alarm:
+            signal.signal(signal.SIGALRM, previous_handler)
+    return recs, num_dropped
+
+
+html_pool = None
+
+
+def get_html_pool(num_proc):
+    """Long-lived pool of html workers, shared by every WARCCurator of this process."""
+    global html_pool
+    if html_pool is None:
+        html_pool = Pool(num_proc)
+    return html_pool
+
+
+def reset_html_pool():
+    """Kill the html workers, e.g. when one hangs in native code where the page timeout cannot reach it."""
+    global html_pool
+    if html_pool is not None:
+        html_pool.terminate()
+        html_pool.join()
+        html_pool = None
+
+
 class WARCCurator(CCCurator):
-    def __init__(self, dedup=True, lid=True):
+    def __init__(self, dedup=True, lid=True, num_proc=8, pages_per_task=50, page_timeout=60, task_timeout=60*5, dedup_store=None, id_hash="uuid5"):
+        """
+        Args:
+        - num_proc: int, html workers in the shared pool, 1 parses in this process
+        - pages_per_task: int, pages sent to a worker at a time, results come back in bulk
+        - page_timeout: int, seconds after which a single page is dropped
+        - task_timeout: int, seconds after which a task is considered stuck and the pool is restarted
+        - dedup_store: store from `utils.url_dedup.open_dedup_store`, defaults to exact dedup within each archive
+        - id_hash: str, one of `ID_HASHES`
+        """
         self.dedup = dedup
-        self.url_dedup = defaultdict(set)
+        self.dedup_store = dedup_store if dedup_store is not None else HashDedupStore()
         self.lid = lid
-
-    def clean_dedup_cache(self):
-        self.url_dedup = defaultdict(set)
+        self.id_hash = id_hash
+        self.num_proc = num_proc
+        self.pages_per_task = pages_per_task
+        self.page_timeout = page_timeout
+        self.task_timeout = task_timeout
 
     def parse(self, cc_file, verbose=False):
         from warcio.archiveiterator import ArchiveIterator
+        cc_name = getattr(cc_file, "name", cc_file)
         data = []
         htmls = []
+        pending = deque()
+        self.num_dropped = 0
         start = time.time()
+        self.dedup_store.begin(os.path.basename(cc_name))
 
-        with open(cc_file, 'rb') as stream:
+        with (open(cc_file, 'rb') if isinstance(cc_file, str) else contextlib.nullcontext(cc_file)) as stream:
             record_iter = ArchiveIterator(stream)
             if verbose:
                 from tqdm import tqdm
@@ -133,107 +317,154 @@ class WARCCurator(CCCurator):
             for ix, record in enumerate(record_iter):
                 if record.rec_type == 'response':
                     htmls.append((record.raw_stream.read().strip(), record.rec_headers.get_header('WARC-Target-URI')))
-                    if len(htmls) >= 500:
-                        # timeout a bad HTML page.
-                        ret_data = Manager().list()
-                        p = Process(target=self.parse_htmls, args=[htmls, ret_data])
-                        p.start()
-                        p.join(60*5)
-                        if p.is_alive():
-                            p.terminate()
-                            print(f"timeout on {cc_file}")
+                    if len(htmls) >= self.pages_per_task:
+                        self._submit(htmls, pending, data)
                         htmls = []
-                        data.extend(ret_data)
 
             if len(htmls) > 0:
-                # timeout a bad HTML page.
-                ret_data = Manager().list()
-                p = Process(target=self.parse_htmls, args=[htmls, ret_data])
-                p.start()
-                p.join(60*5)
-                if p.is_alive():
-                    p.terminate()
-                    logging.info(f"timeout on {cc_file}")
-                htmls = []
-                data.extend(ret_data)
-        logging.info(f"{cc_file}: {time.time() - start} seconds, len(data)={len(data)}")
+                self._submit(htmls, pending, data)
+            while pending:
+                self._collect(pending, data)
+        self.dedup_store.flush()
+        logging.info(f"{cc_name}: {time.time() - start} seconds, len(data)={len(data)}, {self.num_dropped} pages dropped")
         return data
 
+    def _submit(self, htmls, pending, data):
+        if self.num_proc <= 1:
+            self._add_batch(parse_html_batch(htmls, self.page_timeout, self.id_hash), data)
+            return
+        pool = get_html_pool(self.num_proc)
+        pending.append((htmls, pool.apply_async(parse_html_batch, (htmls, self.page_timeout, self.id_hash))))
+        # bound the pages held in memory, results are collected in submission order to keep the output deterministic
+        while len(pending) > 2 * self.num_proc:
+            self._collect(pending, data)
+
+    def _collect(self, pending, data):
+        htmls, result = pending.popleft()
+        try:
+            batch = result.get(self.task_timeout)
+        except multiprocessing.TimeoutError:
+            print(f"html task timed out after {self.task_timeout} seconds, restarting the html workers")
+            self.num_dropped += len(htmls)
+            reset_html_pool()
+            # the other queued tasks died with the pool, send them again
+            resubmit = [htmls for htmls, _ in pending]
+            pending.clear()
+            for htmls in resubmit:
+                self._submit(htmls, pending, data)
+            return
+        self._add_batch(batch, data)
+
+    def _add_batch(self, batch, data):
+        recs, num_dropped = batch
+        self.num_dropped += num_dropped
+        for rec in recs:
+            rec["texts"] = self.dedup_texts(rec)
+            if len(rec["texts"]) > 0:
+                data.append(rec)
+
     def parse_htmls(self, htmls, data):
         for html, target_uri in htmls:
             self.parse_html(html, target_uri, data)
 
     def parse_html(self, html, target_uri, data):
-        from selectolax.parser import HTMLParser
-        tree = HTMLParser(html)
-        for img_node in tree.tags("img"):
-            texts = []
-            url = None
-            for key in img_node.attrs.keys():
-                if key not in CCCurator.KOI + ["src"]:
-                    continue
-
-                text = img_node.attrs[key]
-                if text is None:
-                    continue
-                text = text.strip().replace("\n", "").replace("\r", "")
-                if len(text) == 0:
-                    continue
-
-                if key == "src":
-                    url = CCCurator.normalize_url(text, target_uri)
-
-                if key in CCCurator.KOI and (not self.lid or (self.lid and lid(text) == "en")):
-                    texts.append([key, text])
-
-            if url is None:
-                continue
-            rec = {"uuid": uuid_from_url(url), "url": url, "texts": []}
-            # dedup on URL.
-            if self.dedup:
-                text_sets = self.url_dedup[rec["uuid"]]
-                for text in texts:
-                    if text[1] not in text_sets:
-                        text_sets.add(text[1])
-                        rec["texts"].append(text)
-            else:
-                rec["texts"] = texts
+        for rec in extract_images_from_html(html, target_uri, self.id_hash):
+            rec["texts"] = self.dedup_texts(rec)
             if len(rec["texts"]) > 0:
                 data.append(rec)
 
 
 class WATCurator(CCCurator):
-    def __init__(self, dedup=True, lid=True):
+    def __init__(self, dedup=True, lid=True, prefilter=None, dedup_store=None, id_hash="uuid5",
+                 match_inline=False, metadata=None, match_backend="auto"):
+        """
+        Args:
+        - prefilter: KeywordPrefilter, optional, records whose raw json contains no keyword token are skipped
+        - dedup_store: store from `utils.url_dedup.open_dedup_store`, defaults to exact dedup within each archive
+        - id_hash: str, one of `ID_HASHES`
+        - match_inline: bool, match the texts of each link while parsing, so only links with a keyword
+          pay for url normalization, id and dedup. Needs `metadata` or a keyword index loaded in this process
+        """
         self.dedup = dedup
-        self.url_dedup = defaultdict(set)
+        self.dedup_store = dedup_store if dedup_store is not None else HashDedupStore()
+        self.id_from_url = get_id_fn(id_hash)
+        self.match_inline = match_inline
+        self.metadata = metadata
+        self.match_backend = match_backend
         self.lid = lid
+        self.prefilter = prefilter
+        self.num_no_image = 0
+        self.num_prefiltered = 0
     
     @timing_decorator
     def parse(self, cc_file, verbose=False):
-        print(f"Parsing {cc_file}...")
+        return list(self.iter_records(cc_file, verbose))
+
+    def iter_batches(self, cc_file, batch_size=100000, verbose=False):
+        """Yield the extracted image records in lists of at most `batch_size`, so memory does not grow with the file."""
+        batch = []
+        for rec in self.iter_records(cc_file, verbose):
+            batch.append(rec)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+
+    def iter_records(self, cc_file, verbose=False):
+        """`cc_file` is a path or a binary file object, e.g. a stream from `utils.cc_stream`."""
+        cc_name = getattr(cc_file, "name", cc_file)
+        print(f"Parsing {cc_name}...")
         data = []
         num_records = 0
+        self.num_no_image = 0
+        self.num_prefiltered = 0
+        self.dedup_store.begin(os.path.basename(cc_name))
         with gzip.open(cc_file) as fr:
             looking_for_json = False
             for line in fr:
-                try:
-                    line = line.decode().strip()
-                except Exception as e:
-                    print(e)
-                    continue
-                if line.startswith("WARC-Target-URI"):
-                    target_uri = line[len("WARC-Target-URI: ") :]
+                # stay on bytes, only the target uri and prefiltered lines are ever decoded
+                line = line.strip()
+                if line.startswith(b"WARC-Target-URI"):
+                    try:
+                        target_uri = line[len(b"WARC-Target-URI: ") :].decode()
+                    except Exception as e:
+                        print(e)
+                        continue
                     looking_for_json = True
-                if looking_for_json and line.startswith("{"):
+                if looking_for_json and line.startswith(b"{"):
                     looking_for_json = False
-                    self.parse_json(line, target_uri, data)
                     num_records += 1
-        print(f"Done parsing {cc_file}, {num_records} records.")
-        return data
+                    if not self.has_image_link(line):
+                        # no image link in this record, skip json parsing
+                        self.num_no_image += 1
+                        continue
+                    if self.prefilter is not None:
+                        try:
+                            keep = self.prefilter.contains_any(line.decode())
+                        except Exception as e:
+                            print(e)
+                            continue
+                        if not keep:
+                            self.num_prefiltered += 1
+                            continue
+                    self.parse_json(line, target_uri, data)
+                    yield from data
+                    data.clear()
+        self.dedup_store.flush()
+        skipped = f"{self.num_no_image} without image links"
+        if self.prefilter is not None:
+            skipped += f", {self.num_prefiltered} skipped by the keyword prefilter"
+        print(f"Done parsing {cc_name}, {num_records} records, {skipped}.")
+
+    @staticmethod
+    def has_image_link(raw_line):
+        # the encoder may escape the slash in the link path
+        return b"IMG@/src" in raw_line or b"IMG@\\/src" in raw_line
 
     def parse_json(self, line, target_uri, data):
         try:
-            record_data = json.loads(line)
+            record_data = json_io.loads(line)
         except Exception as e:  # pylint: disable=bare-except
             print(f"one record failed: {e}")
             return
@@ -253,17 +484,12 @@ class WATCurator(CCCurator):
         self, links, target_uri
     ):
         results = []
+        resolved = {}
         for link in links:
             if link is None or "path" not in link or link["path"] is None:
                 continue
             if not link["path"].startswith("IMG@/src") or "url" not in link:
                 continue
-            url = CCCurator.normalize_url(link["url"], target_uri)
-            if url is None:
-                continue
-            uuid = uuid_from_url(url)
-            if uuid is None:
-                continue
 
             texts = []
             for key in CCCurator.KOI:
@@ -275,37 +501,81 @@ class WATCurator(CCCurator):
                 text = text.replace("\n", " ").replace("\r", " ").strip()
                 if len(text) == 0:
                     continue
-                texts.append([key, text])
-            
-            rec = {"uuid": uuid, "url": url, "texts": []}
+                if self.match_inline:
+                    matched_entry_ids = substr_matching(text, self.metadata, backend=self.match_backend)
+                    if len(matched_entry_ids) == 0:
+                        continue
+                    texts.append([key, text, matched_entry_ids])
+                else:
+                    texts.append([key, text])
+            # links without (matching) texts never reach the output, skip their url work
+            if len(texts) == 0:
+                continue
+
+            # links of a page share the base uri and often the same src
+            if link["url"] not in resolved:
+                url = CCCurator.normalize_url(link["url"], target_uri)
+                resolved[link["url"]] = (url, self.id_from_url(url) if url is not None else None)
+            url, uuid = resolved[link["url"]]
+            if url is None:
+                continue
+
+            rec = {"uuid": uuid, "url": url, "texts": texts}
             # dedup on URL.
-            if self.dedup:
-                text_sets = self.url_dedup[rec["uuid"]]
-                for text in texts:
-                    if text[1] not in text_sets:
-                        text_sets.add(text[1])
-                        rec["texts"].append(text)
-            else:
-                rec["texts"] = texts
+            rec["texts"] = self.dedup_texts(rec)
             if len(rec["texts"]) > 0:
                 results.append(rec)
 
         return results
 
 
-def process(cc_file, output_file, metadata_file):
-    if cc_file.endswith("wat.gz"):
-        parser = WATCurator(dedup=True, lid=True)
-    elif cc_file.endswith("warc.gz"):
-        parser = WARCCurator(dedup=True, lid=True)
+@timing_decorator
+def process_streaming(parser, cc_file, output_file, metadata=None, match_backend="auto", pool=None, batch_size=100000, num_proc=20):
+    """parse -> match -> write in batches of `batch_size` records, the output is the same as matching the whole file at once."""
+    num_matched = 0
+    with JsonArrayWriter(output_file) as writer:
+        for batch in parser.iter_batches(cc_file, batch_size):
+            matched = parser.substrmatch(batch, metadata, num_proc, backend=match_backend, pool=pool)
+            writer.write_all(matched)
+            num_matched += len(matched)
+    print(f"Saved {num_matched} matched records to {output_file}.")
+
+
+def process(cc_file, output_file, metadata_file, match_backend="auto", pool=None, batch_size=100000, prefilter=None, num_proc=20, lid=True, dedup_store=None, id_hash="uuid5"):
+    """
+    Args:
+    - metadata_file: str, keyword json, can be None when `pool` is given or this process
+      already loaded the keyword index with `load_keyword_index`
+    - num_proc: int, matching processes to start when no `pool` is given, 1 matches in this process
+    - lid: bool, keep only matched texts identified as english
+    - dedup_store: store from `utils.url_dedup.open_dedup_store` shared across archives, defaults to dedup within this archive
+    - id_hash: str, one of `ID_HASHES`, how image ids are computed from their url
+    """
+    metadata = None
+    if pool is None and metadata_file is not None:
+        metadata = json_io.load(metadata_file)
+
+    # `cc_file` may also be a stream, the format is told from its name
+    cc_name = getattr(cc_file, "name", cc_file)
+    if cc_name.endswith("wat.gz"):
+        # without a pool of matching processes the texts are matched right when they are parsed
+        parser = WATCurator(dedup=True, lid=lid, prefilter=prefilter, dedup_store=dedup_store, id_hash=id_hash,
+                            match_inline=pool is None and num_proc <= 1, metadata=metadata, match_backend=match_backend)
+    elif cc_name.endswith("warc.gz"):
+        parser = WARCCurator(dedup=True, lid=lid, num_proc=num_proc, dedup_store=dedup_store, id_hash=id_hash)
     else:
-        raise ValueError(f"unknown cc extension {cc_file}")
+        raise ValueError(f"unknown cc extension {cc_name}")
 
-    data = parser.parse(cc_file)
+    if isinstance(parser, WATCurator):
+        if pool is None and num_proc > 1:
+            with Pool(num_proc) as pool:
+                process_streaming(parser, cc_file, output_file, metadata, match_backend, pool, batch_size, num_proc)
+        else:
+            process_streaming(parser, cc_file, output_file, metadata, match_backend, pool, batch_size, num_proc)
+        return
 
-    with open(metadata_file) as f:
-        metadata = json.load(f)
-    data = parser.substrmatch(data, metadata)
+    data = parser.parse(cc_file)
+    data = parser.substrmatch(data, metadata, num_proc, backend=match_backend, pool=pool)
     parser.save_json(output_file, data)
 
 
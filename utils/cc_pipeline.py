@@ -0,0 +1,250 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from .cc_matching import process
+from .cc_stream import open_cc_stream
+from .substr_matching import load_keyword_index
+from .url_dedup import open_dedup_store
+
+
+worker_prefilter = None
+worker_s3_client = None
+worker_dedup_store = None
+
+
+def archive_output_file(data_uri: str, folder: str) -> str:
+    return os.path.join(folder, os.path.basename(data_uri).replace('.wat.gz', '.json').replace('.warc.gz', '.json'))
+
+
+def download_archive(s3_client, data_uri: str, temp_folder: str, bucket_name: str = 'commoncrawl') -> str:
+    """
+    Download a cc archive into `temp_folder` and return the local path.
+    The download goes to a `.part` file first, so an interrupted download is never mistaken for a complete one.
+    """
+    os.makedirs(temp_folder, exist_ok=True)
+    # get the prefix for s3 from the uri, e.g., remove s3://commoncrawl/
+    s3_prefix = data_uri.split(f'{bucket_name}/', 1)[1]
+    local_file_path = os.path.join(temp_folder, os.path.basename(data_uri))
+    if os.path.exists(local_file_path):
+        print(f'{local_file_path} already exists, proceed with the existing file.')
+        return local_file_path
+    print(f'Downloading {data_uri} from s3...')
+    part_path = f'{local_file_path}.part'
+    try:
+        s3_client.download_file(bucket_name, s3_prefix, part_path)
+    except Exception:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    os.replace(part_path, local_file_path)
+    return local_file_path
+
+
+def init_pipeline_worker(index_path: str, keyword_prefilter: bool, s3_client_kwargs: dict = None, dedup_kwargs: dict = None):
+    global worker_prefilter, worker_s3_client, worker_dedup_store
+    worker_prefilter = load_keyword_index(index_path, keep_prefilter=keyword_prefilter)
+    # one dedup store per worker, reused for all archives it processes
+    worker_dedup_store = open_dedup_store(**(dedup_kwargs or {}))
+    if s3_client_kwargs is not None:
+        # clients cannot be pickled, every streaming worker opens its own
+        import boto3
+        worker_s3_client = boto3.client('s3', **s3_client_kwargs)
+
+
+def process_local_archive(local_file_path: str, output_file: str, batch_size: int, lid: bool = True, id_hash: str = 'uuid5') -> float:
+    """Parse and match one downloaded archive inside a pipeline worker, returns the elapsed seconds."""
+    start = time.time()
+    process(local_file_path, output_file, None, batch_size=batch_size, prefilter=worker_prefilter, num_proc=1, lid=lid, dedup_store=worker_dedup_store, id_hash=id_hash)
+    return time.time() - start
+
+
+def process_remote_archive(data_uri: str, output_file: str, batch_size: int, bucket_name: str, http_prefix: str = None, lid: bool = True, id_hash: str = 'uuid5') -> float:
+    """Stream, parse and match one archive inside a pipeline worker without a local copy, returns the elapsed seconds."""
+    start = time.time()
+    with open_cc_stream(data_uri, worker_s3_client, bucket_name, http_prefix) as stream:
+        process(stream, output_file, None, batch_size=batch_size, prefilter=worker_prefilter, num_proc=1, lid=lid, dedup_store=worker_dedup_store, id_hash=id_hash)
+    return time.time() - start
+
+
+class PipelineProgress(object):
+    """Counts finished archives, reports them to the work manifest (if any) and keeps the leases of running ones alive."""
+
+    def __init__(self, manifest=None, max_files: int = None, renew_interval: float = 60):
+        self.manifest = manifest
+        self.max_files = max_files
+        self.renew_interval = renew_interval
+        self.running = set()
+        self.num_claimed, self.num_done, self.num_failed = 0, 0, 0
+        self.start = self.last_renew = time.time()
+
+    def next_uri(self, uri_iter):
+        """Next archive this node may work on, None when there is nothing left to claim."""
+        if self.max_files is not None and self.num_claimed >= self.max_files:
+            return None
+        for data_uri in uri_iter:
+            if self.manifest is None or self.manifest.claim(data_uri):
+                self.num_claimed += 1
+                self.running.add(data_uri)
+                return data_uri
+        return None
+
+    def done(self, data_uri: str, elapsed: float):
+        self.running.discard(data_uri)
+        self.num_done += 1
+        if self.manifest is not None:
+            self.manifest.complete(data_uri, elapsed)
+        print(f'Processed {data_uri} in {elapsed:.2f} seconds ({self.num_done} done, {self.num_failed} failed, '
+              f'{(time.time() - self.start) / self.num_done:.2f} seconds per file overall).')
+
+    def failed(self, data_uri: str, error: Exception):
+        self.running.discard(data_uri)
+        self.num_failed += 1
+        if self.manifest is not None:
+            self.manifest.fail(data_uri, error)
+        print(f'Failed to process {data_uri}: {error}')
+
+    def renew(self):
+        if self.manifest is not None and time.time() - self.last_renew > self.renew_interval:
+            self.manifest.renew(list(self.running))
+            self.last_renew = time.time()
+
+    def release(self):
+        """Give back archives that were claimed but not finished, e.g. on an interrupt, so they are retried."""
+        for data_uri in list(self.running):
+            self.failed(data_uri, 'interrupted')
+
+    def finish(self):
+        print(f'Pipeline finished: {self.num_done} files processed, {self.num_failed} failed in {time.time() - self.start:.2f} seconds.')
+
+
+def run_streaming_pipeline(data_uris: list[str],
+                           output_folder: str,
+                           index_path: str,
+                           bucket_name: str = 'commoncrawl',
+                           workers: int = 4,
+                           batch_size: int = 100000,
+                           keyword_prefilter: bool = False,
+                           s3_client_kwargs: dict = None,
+                           http_prefix: str = None,
+                           manifest=None,
+                           max_files: int = None,
+                           lid: bool = True,
+                           dedup_kwargs: dict = None,
+                           id_hash: str = 'uuid5') -> None:
+    """
+    Like `run_pipeline`, but every worker streams its archive straight from s3 (or `http_prefix`), nothing is written to local disk.
+    Args:
+    - s3_client_kwargs: dict, arguments of `boto3.client('s3', ...)` for the clients opened in the workers
+    - http_prefix: str, read `<http_prefix>/<key>` over http instead of s3, e.g. https://data.commoncrawl.org/
+    """
+    progress = PipelineProgress(manifest, max_files)
+    uri_iter = iter(data_uris)
+    processing = {}
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_pipeline_worker,
+                                 initargs=(index_path, keyword_prefilter, s3_client_kwargs if http_prefix is None else None, dedup_kwargs)) as executor:
+            while True:
+                # claim only what the workers can start on, the rest stays available to other nodes
+                while len(processing) < workers:
+                    data_uri = progress.next_uri(uri_iter)
+                    if data_uri is None:
+                        break
+                    output_file = archive_output_file(data_uri, output_folder)
+                    processing[executor.submit(process_remote_archive, data_uri, output_file, batch_size, bucket_name, http_prefix, lid, id_hash)] = data_uri
+                if not processing:
+                    break
+
+                done, _ = wait(list(processing), timeout=progress.renew_interval, return_when=FIRST_COMPLETED)
+                progress.renew()
+                for future in done:
+                    data_uri = processing.pop(future)
+                    try:
+                        progress.done(data_uri, future.result())
+                    except Exception as e:
+                        progress.failed(data_uri, e)
+    finally:
+        progress.release()
+    progress.finish()
+
+
+def run_pipeline(data_uris: list[str],
+                 output_folder: str,
+                 s3_client,
+                 index_path: str,
+                 temp_folder: str = 'temp_data/cc/temp_file/',
+                 bucket_name: str = 'commoncrawl',
+                 prefetch: int = 2,
+                 workers: int = 4,
+                 batch_size: int = 100000,
+                 keyword_prefilter: bool = False,
+                 manifest=None,
+                 max_files: int = None,
+                 lid: bool = True,
+                 dedup_kwargs: dict = None,
+                 id_hash: str = 'uuid5') -> None:
+    """
+    Download the next `prefetch` archives while `workers` processes parse and match the ones already downloaded.
+    At most `prefetch + workers` archives are on local disk at any time.
+    Args:
+    - data_uris: list[str], s3 uris of the archives to process
+    - output_folder: str, folder for the match json files
+    - s3_client: boto3.client, shared by the download threads
+    - index_path: str, cached keyword index from `build_keyword_index`, loaded once per worker
+    - prefetch: int, number of concurrent downloads
+    - workers: int, number of parse and match processes, each matches in-process
+    - manifest: WorkManifest, optional, archives are claimed before they are downloaded and their outcome is recorded
+    - max_files: int, optional, stop after claiming this many archives
+    - lid: bool, keep only matched texts identified as english
+    - dedup_kwargs: dict, arguments of `open_dedup_store` for the store opened in every worker
+    - id_hash: str, "uuid5" or "xxhash", how image ids are computed from their url
+    """
+    max_local_files = prefetch + workers
+    progress = PipelineProgress(manifest, max_files)
+    uri_iter = iter(data_uris)
+    downloads = {}
+    processing = {}
+
+    try:
+        with ThreadPoolExecutor(max_workers=prefetch) as downloader, \
+                ProcessPoolExecutor(max_workers=workers, initializer=init_pipeline_worker,
+                                    initargs=(index_path, keyword_prefilter, None, dedup_kwargs)) as executor:
+            while True:
+                # keep the download queue full as long as the disk budget allows
+                while len(downloads) + len(processing) < max_local_files:
+                    data_uri = progress.next_uri(uri_iter)
+                    if data_uri is None:
+                        break
+                    downloads[downloader.submit(download_archive, s3_client, data_uri, temp_folder, bucket_name)] = data_uri
+
+                # hand finished downloads to idle workers
+                for future in [f for f in downloads if f.done()]:
+                    if len(processing) >= workers:
+                        break
+                    data_uri = downloads.pop(future)
+                    try:
+                        local_file_path = future.result()
+                    except Exception as e:
+                        progress.failed(data_uri, e)
+                        continue
+                    output_file = archive_output_file(data_uri, output_folder)
+                    processing[executor.submit(process_local_archive, local_file_path, output_file, batch_size, lid, id_hash)] = (data_uri, local_file_path)
+
+                if not downloads and not processing:
+                    break
+                waiting = list(processing) if len(processing) >= workers else list(processing) + list(downloads)
+                done, _ = wait(waiting, timeout=progress.renew_interval, return_when=FIRST_COMPLETED)
+                progress.renew()
+
+                for future in done:
+                    if future not in processing:
+                        continue
+                    data_uri, local_file_path = processing.pop(future)
+                    try:
+                        progress.done(data_uri, future.result())
+                    except Exception as e:
+                        progress.failed(data_uri, e)
+                    os.remove(local_file_path)
+    finally:
+        progress.release()
+    progress.finish()
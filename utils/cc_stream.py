@@ -0,0 +1,124 @@
+import io
+import time
+
+
+def is_permanent_error(e: Exception) -> bool:
+    """Client errors such as a missing key will not go away by retrying, timeouts and throttling will."""
+    status = getattr(e, "code", None)
+    response = getattr(e, "response", None)
+    if status is None and isinstance(response, dict):
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return isinstance(status, int) and 400 <= status < 500 and status not in (408, 429)
+
+
+class ResumableStream(io.RawIOBase):
+    """
+    Read-only file object over a remote archive that reconnects on errors and resumes at the current byte offset,
+    so a connection dropped in the middle of a WAT file does not restart it.
+    Wrap it in `gzip.open` to decode the archive incrementally without a temp file.
+    """
+
+    def __init__(self, open_range, name: str, start: int = 0, max_retries: int = 5, backoff: float = 1.0):
+        """
+        Args:
+        - open_range: callable, `open_range(offset)` returns `(body, total_size)` where `body` has `read(n)`
+          and `close()` and yields the object from `offset` on
+        - name: str, shown in logs and used to tell the archive format
+        - start: int, byte offset to start reading from
+        - max_retries: int, consecutive failed attempts before giving up
+        - backoff: float, seconds to wait before the first retry, doubled for each further one
+        """
+        self.open_range = open_range
+        self.name = name
+        self.offset = start
+        self.total_size = None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.num_retries = 0
+        self.body = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        attempts = 0
+        while True:
+            try:
+                if self.body is None:
+                    self.body, self.total_size = self.open_range(self.offset)
+                if self.total_size is not None and self.offset >= self.total_size:
+                    return 0
+                data = self.body.read(len(buffer))
+                if len(data) == 0 and self.total_size is not None and self.offset < self.total_size:
+                    raise IOError(f"connection closed at byte {self.offset} of {self.total_size}")
+                buffer[:len(data)] = data
+                self.offset += len(data)
+                return len(data)
+            except Exception as e:
+                self._close_body()
+                attempts += 1
+                self.num_retries += 1
+                if attempts > self.max_retries or is_permanent_error(e):
+                    # a plain IOError, http and boto errors hold open connections and cannot be sent between processes
+                    raise IOError(f"reading {self.name} failed at byte {self.offset} after {attempts} attempts: {e}") from None
+                wait = self.backoff * 2 ** (attempts - 1)
+                print(f"Reading {self.name} failed at byte {self.offset} ({e}), retrying in {wait:.1f} seconds...")
+                time.sleep(wait)
+
+    def _close_body(self):
+        if self.body is not None:
+            try:
+                self.body.close()
+            except Exception:
+                pass
+            self.body = None
+
+    def close(self):
+        self._close_body()
+        super().close()
+
+
+def open_s3_stream(s3_client, bucket: str, key: str, **kwargs) -> io.BufferedReader:
+    """Stream an s3 object with ranged `get_object` requests."""
+    def open_range(offset):
+        request = {"Bucket": bucket, "Key": key}
+        if offset > 0:
+            request["Range"] = f"bytes={offset}-"
+        response = s3_client.get_object(**request)
+        return response["Body"], offset + response["ContentLength"]
+    return io.BufferedReader(ResumableStream(open_range, f"s3://{bucket}/{key}", **kwargs), buffer_size=1 << 20)
+
+
+def open_http_stream(url: str, timeout: int = 60, **kwargs) -> io.BufferedReader:
+    """Stream a file over http(s) with `Range` requests, e.g. from https://data.commoncrawl.org/ or a local server."""
+    import urllib.request
+
+    def open_range(offset):
+        request = urllib.request.Request(url)
+        if offset > 0:
+            request.add_header("Range", f"bytes={offset}-")
+        response = urllib.request.urlopen(request, timeout=timeout)
+        length = response.headers.get("Content-Length")
+        if offset > 0 and response.status != 206:
+            # the server ignored the range, skip what was already read
+            remaining = offset
+            while remaining > 0:
+                skipped = len(response.read(min(remaining, 1 << 20)))
+                if skipped == 0:
+                    raise IOError(f"{url} ended before byte {offset}")
+                remaining -= skipped
+            return response, int(length) if length is not None else None
+        return response, offset + int(length) if length is not None else None
+
+    return io.BufferedReader(ResumableStream(open_range, url, **kwargs), buffer_size=1 << 20)
+
+
+def open_cc_stream(data_uri: str, s3_client=None, bucket_name: str = "commoncrawl", http_prefix: str = None, **kwargs) -> io.BufferedReader:
+    """
+    Open a cc archive given by its s3 uri as a resumable stream.
+    Reads from s3 with `s3_client`, or over http from `http_prefix` + key when it is given.
+    """
+    key = data_uri.split(f"{bucket_name}/", 1)[1]
+    if http_prefix is not None:
+        return open_http_stream(http_prefix.rstrip("/") + "/" + key, **kwargs)
+    return open_s3_stream(s3_client, bucket_name, key, **kwargs)
@@ -1,84 +1,551 @@
+import io
 import os
-import json
+import time
+import tarfile
+import contextlib
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 
+import numpy as np
 import torch
-from torch.utils.data import Dataset
+from tqdm import tqdm
+from torch.utils.data import Dataset, IterableDataset
+
+from . import json_io
+from .shards import iter_shard
+from .image_validation import image_file_name
+
+PRECISIONS = ["fp32", "bf16", "int8"]
+DECODERS = ["pil", "torchvision"]
+# prompts a class name is encoded with, a subset of the ensemble the CLIP authors used for ImageNet
+PROMPT_TEMPLATES = ["a photo of a {}.", "a bad photo of the {}.", "a photo of the large {}.", "a photo of the small {}.",
+                    "art of the {}.", "a {} in a video game.", "itap of a {}."]
+
+def image_path(item: dict, image_folder: str) -> str:
+    """Path of a downloaded image, named like the files of download_cc_images.py."""
+    return os.path.join(image_folder, image_file_name(item))
+
+def load_rgb(source, decoder: str = "pil", draft_size: int = None) -> Image.Image:
+    """
+    RGB image from a path or bytes. With "pil", JPEGs are decoded at a reduced scale with `draft`, no smaller than
+    `draft_size` on either side, which skips most of the decoding work of photos far larger than the model input.
+    "torchvision" decodes with torchvision.io instead, libjpeg-turbo at full scale, fast for images near the input size.
+    """
+    if decoder not in DECODERS:
+        raise ValueError(f"unknown decoder {decoder}, expected one of {DECODERS}")
+    if decoder == "torchvision":
+        from torchvision.io import ImageReadMode, decode_image, read_file
+        data = torch.frombuffer(bytearray(source), dtype=torch.uint8) if isinstance(source, bytes) else read_file(source)
+        return Image.fromarray(decode_image(data, mode=ImageReadMode.RGB).permute(1, 2, 0).numpy())
+    with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as image:
+        if draft_size and image.format == "JPEG":
+            image.draft("RGB", (draft_size, draft_size))
+        return image.convert("RGB")
 
 class DatasetFromJson(Dataset):
-    def __init__(self, json_path: str, image_folder: str, transform: callable = None):
+    def __init__(self, json_path: str | list[str], image_folder: str, transform: callable = None, uuids: set = None,
+                 decoder: str = "pil", draft_size: int = None):
         """
+        Images that were not downloaded are left out and listed in `missing`. An image that cannot be decoded
+        is returned as None, use `collate_decoded` to drop it from its batch.
         Args:
-        - json_path: str, path to the json file containing the metadata
+        - json_path: str | list[str], path to the json file containing the metadata, or several of them read as one dataset
         - image_folder: str, path to the folder containing images
         - transform: callable, a function that takes in an image and returns a transformed version
+        - uuids: set, optional, only load these images, e.g. those missing from an `EmbeddingCache`
+        - decoder: str, "pil" or "torchvision", see `load_rgb`
+        - draft_size: int, optional, smallest side JPEGs are decoded at by "pil", e.g. the input resolution of the model
         """
         self.json_path = json_path
         self.image_folder = image_folder
         self.transform = transform
-        
+        self.uuids = uuids
+        self.decoder = decoder
+        self.draft_size = draft_size
+
         # Construct the data from the json file
         self._construct_data_from_json(json_path, image_folder)
 
-    def _construct_data_from_json(self, json_path: str, image_folder: str) -> None:
-        self.metadata = json.load(open(json_path, "r"))
+    def _construct_data_from_json(self, json_path: str | list[str], image_folder: str) -> None:
         self.samples = []
         self.image_ids = []
         self.targets = []
-        for item in self.metadata:
-            image_id = item['uuid']
-            image_ext = os.path.splitext(item['url'])[1] or '.jpg'
-            image_path = os.path.join(image_folder, f"{image_id}{image_ext}")
-            class_id = item['texts'][0][2][0]
-            self.samples.append((image_path, class_id))
-            self.image_ids.append(image_id)
-            self.targets.append(class_id)
-    
+        self.missing = []
+        # one scan of the folder instead of a stat per image
+        existing = set(os.listdir(image_folder)) if os.path.isdir(image_folder) else set()
+        seen = set()
+        # the metadata is not kept, every DataLoader worker would hold a copy of it
+        for json_file in [json_path] if isinstance(json_path, str) else json_path:
+            for item in json_io.load(json_file):
+                if "duplicate_of" in item:
+                    # near-duplicate of another image, see dedup_images.py
+                    continue
+                image_id = item['uuid']
+                if image_id in seen or (self.uuids is not None and image_id not in self.uuids):
+                    continue
+                seen.add(image_id)
+                path = image_path(item, image_folder)
+                if os.path.basename(path) not in existing:
+                    self.missing.append(image_id)
+                    continue
+                class_id = item['class_id'][0]
+                self.samples.append((path, class_id))
+                self.image_ids.append(image_id)
+                self.targets.append(class_id)
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
     def __getitem__(self, index: int) -> tuple:
         image_path, target = self.samples[index]
-        image = Image.open(image_path).convert("RGB")
-        if self.transform:
-            image = self.transform(image)
-        return image, target
-            
-            
+        try:
+            image = load_rgb(image_path, self.decoder, self.draft_size)
+            if self.transform:
+                image = self.transform(image)
+        except Exception:
+            return None, target, self.image_ids[index]
+        return image, target, self.image_ids[index]
+
+
+class ShardDataset(IterableDataset):
+    def __init__(self, json_path: str | list[str], shard_folder: str, transform: callable = None, uuids: set = None,
+                 decoder: str = "pil", draft_size: int = None):
+        """
+        Images of download metadata jsons that were written to tar shards, read front to back one shard at a time.
+        The shards are split between the workers of a DataLoader, so samples come in shard order
+        and each one is returned with its uuid. Images of missing shards are listed in `missing`, an image that
+        cannot be decoded is returned as None, use `collate_decoded` to drop it from its batch.
+        Args:
+        - json_path: str | list[str], metadata json written by `download_cc_images.py --shards`, or several of them
+        - shard_folder: str, path to the folder containing the shards
+        - transform: callable, a function that takes in an image and returns a transformed version
+        - uuids: set, optional, only load these images, e.g. those missing from an `EmbeddingCache`
+        - decoder: str, "pil" or "torchvision", see `load_rgb`
+        - draft_size: int, optional, smallest side JPEGs are decoded at by "pil", e.g. the input resolution of the model
+        """
+        self.json_path = json_path
+        self.shard_folder = shard_folder
+        self.transform = transform
+        self.decoder = decoder
+        self.draft_size = draft_size
+        self.targets = {}
+        self.missing = []
+        existing = set(os.listdir(shard_folder)) if os.path.isdir(shard_folder) else set()
+        shards = set()
+        seen = set()
+        for json_file in [json_path] if isinstance(json_path, str) else json_path:
+            for item in json_io.load(json_file):
+                # near-duplicates marked by dedup_images.py are skipped
+                if "shard" not in item or "duplicate_of" in item or (uuids is not None and item["uuid"] not in uuids):
+                    continue
+                if item["uuid"] in seen:
+                    continue
+                seen.add(item["uuid"])
+                if item["shard"] not in existing:
+                    self.missing.append(item["uuid"])
+                    continue
+                self.targets[item["uuid"]] = item["class_id"][0]
+                shards.add(item["shard"])
+        self.shards = sorted(shards)
+
+    def __len__(self) -> int:
+        return len(self.targets)
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        shards = self.shards if worker_info is None else self.shards[worker_info.id::worker_info.num_workers]
+        for shard in shards:
+            try:
+                for key, sample in iter_shard(os.path.join(self.shard_folder, shard)):
+                    if key not in self.targets:
+                        continue
+                    try:
+                        image = load_rgb(next(data for ext, data in sample.items() if ext != ".json"), self.decoder, self.draft_size)
+                        if self.transform:
+                            image = self.transform(image)
+                    except Exception:
+                        image = None
+                    yield image, self.targets[key], key
+            except (OSError, tarfile.TarError) as e:
+                # a truncated shard, the images after the damage are not returned
+                print(f"Failed to read shard {shard}: {e}")
+
+
+def collate_decoded(batch: list) -> tuple:
+    """
+    Collate function of the datasets above that drops the images that could not be decoded. Returns the images,
+    targets and uuids of the others, the images are None when none is left, and the uuids of the dropped ones.
+    """
+    decoded = [sample for sample in batch if sample[0] is not None]
+    failed = [sample[2] for sample in batch if sample[0] is None]
+    if not decoded:
+        return None, [], [], failed
+    images, targets, keys = torch.utils.data.default_collate(decoded)
+    return images, targets, list(keys), failed
+
+
+def configure_threads(threads: int = None, interop_threads: int = None) -> None:
+    """Threads of torch's cpu kernels, `threads` within an op and `interop_threads` across ops, None keeps the default."""
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        # may only be set once per process, before any parallel work
+        torch.set_num_interop_threads(interop_threads)
+
+
+def prepare_model(model: torch.nn.Module, device: str = "cuda:0", precision: str = "fp32") -> torch.nn.Module:
+    """
+    Model for image encoding at `precision`: "fp32" as loaded, "bf16" runs under autocast, see `autocast`,
+    "int8" quantizes the linear layers of the visual tower dynamically, cpu only.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"unknown precision {precision}, expected one of {PRECISIONS}")
+    model.eval()
+    if precision == "int8":
+        if torch.device(device).type != "cpu":
+            raise ValueError("int8 dynamic quantization runs on cpu only")
+        from torch.ao.quantization import quantize_dynamic
+        # weights are stored as int8, activations are quantized on the fly, the text tower is left as is
+        model.visual = quantize_dynamic(model.visual, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def autocast(device: str, precision: str = "fp32"):
+    if precision == "bf16":
+        return torch.autocast(torch.device(device).type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def available_memory(device: str) -> int:
+    """Free bytes of a cuda device, or the memory the OS reports as available for a cpu."""
+    if torch.device(device).type == "cuda":
+        return torch.cuda.mem_get_info(device)[0]
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def peak_memory(fn: callable, device: str) -> int:
+    """Peak bytes allocated by torch while running `fn`, on cpu replayed from the allocations the profiler records."""
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        before = torch.cuda.memory_allocated(device)
+        fn()
+        return torch.cuda.max_memory_allocated(device) - before
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as profiler:
+        fn()
+    allocated = peak = 0
+    for event in sorted(profiler.events(), key=lambda event: event.time_range.start):
+        allocated += event.self_cpu_memory_usage
+        peak = max(peak, allocated)
+    return peak
+
+
+def auto_batch_size(model: torch.nn.Module,
+                    transforms: callable,
+                    device: str = "cuda:0",
+                    precision: str = "fp32",
+                    max_batch_size: int = 512,
+                    memory_fraction: float = 0.5,
+                    probe_size: int = 16
+                    ) -> int:
+    """
+    Largest power of two batch size whose activations fit in `memory_fraction` of the available memory,
+    measured from the peak memory of encoding a probe batch of `probe_size` blank images.
+    """
+    batch = transforms(Image.new("RGB", (224, 224))).unsqueeze(0).repeat(probe_size, 1, 1, 1).to(device)
+    with torch.inference_mode(), autocast(device, precision):
+        # warm up, lazily initialized kernels and buffers do not grow with the batch
+        model.encode_image(batch[:1])
+        per_image = max(peak_memory(lambda: model.encode_image(batch), device) / probe_size, 1)
+    fitting = int(available_memory(device) * memory_fraction / per_image)
+    batch_size = 1 << max(min(fitting, max_batch_size).bit_length() - 1, 0)
+    print(f"Using batch size {batch_size}, about {per_image / 2 ** 20:.1f} MiB per image on {device}")
+    return batch_size
+
+
+def encode_classes(model: torch.nn.Module,
+                   class_names: list[str],
+                   device: str = "cuda:0",
+                   templates: list[str] = None,
+                   batch_size: int = 1024
+                   ) -> torch.Tensor:
+    """
+    Normalized text embedding of every class, shape (num_classes, dim), the mean over its prompts, the `templates`
+    filled in with the class name. All prompts are encoded once per run, in batches.
+    """
+    import clip
+    templates = templates or PROMPT_TEMPLATES
+    prompts = [template.format(name) for name in class_names for template in templates]
+    features = []
+    with torch.inference_mode():
+        for start in range(0, len(prompts), batch_size):
+            tokens = clip.tokenize(prompts[start:start + batch_size], truncate=True).to(device)
+            prompt_features = model.encode_text(tokens).float()
+            features.append(prompt_features / prompt_features.norm(dim=-1, keepdim=True))
+    class_features = torch.cat(features).view(len(class_names), len(templates), -1).mean(dim=1)
+    return class_features / class_features.norm(dim=-1, keepdim=True)
+
+
+def class_scores(image_features: np.ndarray, class_features: torch.Tensor, matched: list[list[int]], top_k: int = 5) -> dict:
+    """
+    Scores of a batch of images against all classes, 100 times the cosine similarity, from one image x class matrix.
+    Returns a dict of numpy arrays, one row per image: "top_classes" and "top_scores", the `top_k` best classes,
+    "class" and "score", the best of the classes an image was matched to, and "margin", how far that score is ahead
+    of the best other class, negative when another class fits the image better and nan when there is none.
+    Args:
+    - image_features: np.ndarray, normalized image embeddings, shape (num_images, dim)
+    - class_features: torch.Tensor, normalized class embeddings from `encode_classes`
+    - matched: list[list[int]], the class ids each image was matched to, e.g. the `class_id` of its metadata
+    """
+    with torch.inference_mode():
+        similarity = 100 * torch.from_numpy(image_features).to(class_features.device) @ class_features.T
+        top_scores, top_classes = similarity.topk(min(top_k, similarity.shape[1]), dim=1)
+        # padded with the first matched class, which does not change the best of them
+        width = max(len(class_ids) for class_ids in matched)
+        index = torch.tensor([class_ids + class_ids[:1] * (width - len(class_ids)) for class_ids in matched],
+                             dtype=torch.long, device=similarity.device)
+        matched_scores = similarity.gather(1, index)
+        best = matched_scores.argmax(dim=1, keepdim=True)
+        score = matched_scores.gather(1, best)[:, 0]
+        others = similarity.scatter(1, index, float("-inf")).max(dim=1).values
+        margin = torch.where(torch.isfinite(others), score - others, float("nan"))
+        result = {"top_classes": top_classes, "top_scores": top_scores, "class": index.gather(1, best)[:, 0],
+                  "score": score, "margin": margin}
+    return {key: value.cpu().numpy() for key, value in result.items()}
+
+
+def image_dataset(model: torch.nn.Module,
+                  transforms: callable,
+                  image_folder: str,
+                  json_path: str | list[str],
+                  shard_folder: str = None,
+                  uuids: set = None,
+                  decoder: str = "pil"
+                  ) -> Dataset:
+    """Dataset of the images of metadata jsons, from tar shards when `shard_folder` is given, JPEGs drafted at the model input size."""
+    # input_resolution of the openai clip image encoders
+    draft_size = getattr(getattr(model, "visual", None), "input_resolution", 224)
+    if shard_folder is not None:
+        return ShardDataset(json_path, shard_folder, transform=transforms, uuids=uuids, decoder=decoder, draft_size=draft_size)
+    return DatasetFromJson(json_path, image_folder, transform=transforms, uuids=uuids, decoder=decoder, draft_size=draft_size)
+
+
+def image_loader(dataset: Dataset, device: str = "cuda:0", batch_size: int = 256, num_workers: int = 12, prefetch_factor: int = 4
+                 ) -> torch.utils.data.DataLoader:
+    """DataLoader of a dataset above, batches are pinned for a fast copy to a cuda device."""
+    if isinstance(dataset, ShardDataset):
+        # a worker without a shard would only start up and stop
+        num_workers = min(num_workers, len(dataset.shards))
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                                       collate_fn=collate_decoded, pin_memory=torch.device(device).type == "cuda", drop_last=False,
+                                       persistent_workers=num_workers > 0, prefetch_factor=prefetch_factor if num_workers > 0 else None)
+
+
+def encode_batches(model: torch.nn.Module,
+                   dataloader: torch.utils.data.DataLoader,
+                   device: str = "cuda:0",
+                   precision: str = "fp32",
+                   stats: Counter = None):
+    """
+    Yield the uuids and normalized float32 embeddings of every batch of `dataloader`, and the uuids of the images
+    of the batch that could not be decoded, counted in `stats` as "encoded" and "failed".
+    """
+    stats = stats if stats is not None else Counter()
+    on_cuda = torch.device(device).type == "cuda"
+    start = time.time()
+    for sample, target, batch_keys, failed in dataloader:
+        if sample is None:
+            image_features = np.zeros((0, 0), dtype=np.float32)
+        else:
+            with torch.inference_mode(), autocast(device, precision):
+                image_features = model.encode_image(sample.to(device, non_blocking=on_cuda)).float()
+            image_features = (image_features / image_features.norm(dim=-1, keepdim=True)).cpu().numpy()
+        stats["encoded"] += len(batch_keys)
+        stats["failed"] += len(failed)
+        stats["seconds"] += time.time() - start
+        yield batch_keys, image_features, failed
+        # the time the caller spends on a batch is not encoding time
+        start = time.time()
+
+
+def score_json_files(model: torch.nn.Module,
+                     transforms: callable,
+                     class_features: torch.Tensor,
+                     image_folder: str,
+                     json_paths: list[str],
+                     on_scored: callable,
+                     device: str = "cuda:0",
+                     shard_folder: str = None,
+                     cache=None,
+                     top_k: int = 5,
+                     batch_size: int = 256,
+                     num_workers: int = 12,
+                     prefetch_factor: int = 4,
+                     precision: str = "fp32",
+                     decoder: str = "pil",
+                     stats: Counter = None,
+                     max_pending_files: int = 16
+                     ) -> None:
+    """
+    Score the images of all metadata files against every class in a single pass, with one dataset over all of them
+    and one DataLoader whose workers keep decoding across file boundaries. Images found in the `cache` are scored
+    up front, an image listed in several files is encoded once and scored against all classes it was matched to
+    in any of them. `on_scored(json_path, metadata)` is called with the scored metadata of a file as soon as the
+    last of its images is encoded; it runs in a background thread, so writing a file does not hold up the next batches.
+    Every scored item gets, see `class_scores`, "clip_score" and "clip_class", the score and id of its best matched
+    class, "clip_margin", its lead over the best other class, and "clip_topk", the `top_k` [class id, score] pairs.
+    The scores and classes of an image are dropped once every file listing it is written.
+    Args:
+    - class_features: torch.Tensor, normalized class embeddings from `encode_classes`, in the order of the class ids
+    - json_paths: list[str], metadata files, encoded in this order
+    - on_scored: callable, called once per file, images that are missing or cannot be decoded have no score
+    - shard_folder: str, optional, read the images from the tar shards in this folder instead of `image_folder`
+    - cache: EmbeddingCache, optional, image embeddings of earlier runs, new embeddings are added to it
+    - top_k: int, best classes kept per image
+    - batch_size: int, images per forward pass, see `auto_batch_size`
+    - num_workers: int, DataLoader processes that decode images
+    - prefetch_factor: int, batches each DataLoader worker decodes ahead
+    - precision: str, "fp32", "bf16" or "int8" for a model from `prepare_model`
+    - decoder: str, "pil" or "torchvision", see `load_rgb`
+    - stats: Counter, optional, adds the "cached", "encoded", "missing" and "failed" images and the "seconds" spent encoding
+    - max_pending_files: int, scored files queued for writing before scoring waits for the writer
+    """
+    stats = stats if stats is not None else Counter()
+    class_features = class_features.to(device)
+    # class ids each image was matched to, over all files listing it, and the images of every file
+    matched = {}
+    file_uuids = []
+    for json_path in json_paths:
+        uuids = []
+        for item in json_io.load(json_path):
+            if "duplicate_of" not in item:
+                matched.setdefault(item["uuid"], set()).update(item["class_id"])
+                uuids.append(item["uuid"])
+        file_uuids.append(list(dict.fromkeys(uuids)))
+    num_classes = len(class_features)
+    if any(class_id >= num_classes for class_ids in matched.values() for class_id in class_ids):
+        raise ValueError(f"the metadata has class ids beyond the {num_classes} classes, was it matched with another keyword json?")
+    # number of files listing each image that are not written yet, its score and classes are dropped once all are
+    unwritten = Counter(uuid for uuids in file_uuids for uuid in uuids)
+    scores = {}
+
+    def score(uuids, image_features):
+        result = class_scores(image_features, class_features, [sorted(matched[uuid]) for uuid in uuids], top_k)
+        for uuid, class_id, clip_score, margin, top_classes, top_scores in zip(
+                uuids, result["class"].tolist(), result["score"].tolist(), result["margin"].tolist(),
+                result["top_classes"].tolist(), result["top_scores"].tolist()):
+            scores[uuid] = {"clip_score": clip_score, "clip_class": class_id, "clip_margin": None if margin != margin else margin,
+                            "clip_topk": [list(pair) for pair in zip(top_classes, top_scores)]}
+
+    # files still waiting for an image, and the number of images each file waits for
+    waiting = {}
+    remaining = [0] * len(json_paths)
+
+    def resolve(uuid):
+        # the image is scored or will never be, one less for the files listing it
+        for index in waiting.pop(uuid, ()):
+            remaining[index] -= 1
+            if remaining[index] == 0:
+                submit(index)
+
+    def write_back(index):
+        metadata = json_io.load(json_paths[index])
+        for item in metadata:
+            if item["uuid"] in scores and "duplicate_of" not in item:
+                item.update(scores[item["uuid"]])
+        on_scored(json_paths[index], metadata)
+        for uuid in file_uuids[index]:
+            unwritten[uuid] -= 1
+            if unwritten[uuid] == 0:
+                del unwritten[uuid]
+                scores.pop(uuid, None)
+                matched.pop(uuid, None)
+        file_uuids[index] = None
+
+    futures = deque()
+
+    def submit(index):
+        futures.append(writer.submit(write_back, index))
+        # the scores of files waiting to be written are kept in memory, let the writer catch up
+        while len(futures) > max_pending_files:
+            futures.popleft().result()
+
+    with ThreadPoolExecutor(1) as writer:
+        for index, uuids in enumerate(file_uuids):
+            new = [uuid for uuid in uuids if uuid not in scores and uuid not in waiting]
+            if cache is not None and new:
+                found, cached = cache.lookup(new)
+                hits = [uuid for uuid, hit in zip(new, found) if hit]
+                for offset in range(0, len(hits), batch_size):
+                    score(hits[offset:offset + batch_size], cached[offset:offset + batch_size])
+                stats["cached"] += len(hits)
+                new = [uuid for uuid, hit in zip(new, found) if not hit]
+            for uuid in new:
+                waiting[uuid] = []
+            for uuid in uuids:
+                if uuid in waiting:
+                    waiting[uuid].append(index)
+                    remaining[index] += 1
+            if remaining[index] == 0:
+                submit(index)
+        if waiting:
+            dataset = image_dataset(model, transforms, image_folder, json_paths, shard_folder, set(waiting), decoder)
+            stats["missing"] += len(dataset.missing)
+            for uuid in dataset.missing:
+                resolve(uuid)
+            dataloader = image_loader(dataset, device, batch_size, num_workers, prefetch_factor)
+            with tqdm(total=len(dataset), desc="Scoring images") as progress:
+                for batch_keys, image_features, failed in encode_batches(model, dataloader, device, precision, stats):
+                    new = [position for position, uuid in enumerate(batch_keys) if uuid in waiting]
+                    if new:
+                        new_keys = [batch_keys[position] for position in new]
+                        score(new_keys, image_features[new])
+                        if cache is not None:
+                            cache.add(new_keys, image_features[new])
+                        for uuid in new_keys:
+                            resolve(uuid)
+                    for uuid in failed:
+                        resolve(uuid)
+                    progress.update(len(batch_keys) + len(failed))
+            # images missing from a damaged shard were never yielded
+            for index in range(len(json_paths)):
+                if remaining[index] > 0:
+                    submit(index)
+        for future in futures:
+            future.result()
+
 def get_clip_scores(model: torch.nn.Module,
                     transforms: callable,
-                    keywords: list[str] | str,
+                    keywords: list[str] | torch.Tensor,
                     image_folder: str,
                     json_path: str,
-                    device: str = "cuda:0"
-                    ) -> dict:
+                    device: str = "cuda:0",
+                    shard_folder: str = None,
+                    cache=None,
+                    **score_kwargs
+                    ) -> list:
     """
-    Based on the input json file, this function will compute the (average) similarity scores between the images and the keywords.
+    Based on the input json file, this function will compute the similarity scores between its images and every class,
+    like `score_json_files` does for many files.
     Args:
     - model: torch.nn.Module, CLIP model
-    - keywords: list[str] | str, list of keywords or a single keyword
+    - keywords: list[str] | torch.Tensor, the keyword json the metadata was matched with, or its class embeddings from `encode_classes`
     - image_folder: str, path to the folder containing images
     - json_path: str, path to the json file containing the metadata
+    - score_kwargs: keyword arguments of `score_json_files`, e.g. top_k, batch_size or precision
     Returns:
-    - dict, the original metadata with the similarity scores added
-    """
-    
-    print(f"Using device: {device}, model: {model}, image_folder: {image_folder}, json_path: {json_path}")
-    print(f"Getting similarity scores for {keywords}...")
-    dataset = DatasetFromJson(json_path, image_folder, transform=transforms)
-    dataloader = torch.utils.data.DataLoader(dataset, batch_size=256, shuffle=False, num_workers=12, pin_memory=True, drop_last=False)
-    
-    text_features = model.encode_text(keywords).to(device)
-    if isinstance(keywords, list):
-        text_features = text_features.mean(dim=0, keepdim=True)
-    
-    sim_scores = []
-    for sample, target in dataloader:
-        with torch.no_grad():
-            image_features = model.encode_image(sample.to(device))
-            # compute cosine similarity between image and text features
-            sim_score = (image_features @ text_features.T).squeeze().cpu().tolist()
-            sim_scores.extend(sim_score)
-    
-    # insert socres into metadata
-    for i, item in enumerate(dataset.metadata):
-        item["clip_score"] = sim_scores[i]
-    
-    return dataset.metadata
\ No newline at end of file
+    - list, the original metadata with the scores added, images that could not be scored have none
+    """
+    class_features = keywords if isinstance(keywords, torch.Tensor) else encode_classes(model, keywords, device)
+    scored = []
+    score_json_files(model, transforms, class_features, image_folder, [json_path], lambda path, metadata: scored.append(metadata),
+                     device, shard_folder, cache, **score_kwargs)
+    return scored[0]
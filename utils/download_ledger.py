@@ -0,0 +1,126 @@
+import os
+import time
+import sqlite3
+
+from . import json_io
+
+
+STATUSES = ["ok", "rejected", "failed"]
+# outcomes that will not change when the url is requested again
+PERMANENT_REASONS = {"not an image", "format", "content type", "too large", "too many pixels", "bad header", "decode",
+                     "http 400", "http 401", "http 403", "http 404", "http 405", "http 406", "http 410", "http 451"}
+
+
+class DownloadLedger(object):
+    """
+    SQLite record of every image download, keyed by uuid and shared by all processes and runs writing the same output.
+    Each image is ok (with the info written to its metadata), rejected (a permanent outcome, e.g. a 404 or not an image)
+    or failed (e.g. a timeout or a 503, retried after a backoff that doubles with every attempt), with the http status,
+    size, latency and time of its last attempt. A run looks up the images of a match file in one query per batch
+    and only downloads those that are new or due for a retry.
+    """
+
+    def __init__(self, path: str, max_attempts: int = 3, backoff: float = 600, flush_size: int = 1000):
+        """
+        Args:
+        - path: str, sqlite database file
+        - max_attempts: int, total attempts of a failed download, the first included, e.g. 3 gives two retries
+        - backoff: float, seconds before the first retry of a failed download, doubled for every further retry,
+          so the defaults retry after 600 and 1200 seconds
+        - flush_size: int, outcomes buffered before they are written in one transaction
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.flush_size = flush_size
+        self.conn = sqlite3.connect(path, timeout=120, isolation_level=None)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS downloads ("
+            "uuid TEXT PRIMARY KEY, url TEXT, source TEXT, status TEXT NOT NULL, reason TEXT, http_status INTEGER, "
+            "bytes INTEGER, latency REAL, attempts INTEGER NOT NULL, finished REAL NOT NULL, retry_after REAL, info TEXT)"
+        )
+        self.pending = []
+
+    def lookup(self, uuids: list[str], batch_size: int = 500) -> dict:
+        """Last outcome of the known uuids, as a dict of uuid -> row dict. Unknown uuids are left out."""
+        self.flush()
+        uuids = list(dict.fromkeys(uuids))
+        rows = {}
+        for start in range(0, len(uuids), batch_size):
+            batch = uuids[start:start + batch_size]
+            cursor = self.conn.execute(
+                f"SELECT uuid, status, reason, attempts, retry_after, info FROM downloads WHERE uuid IN ({','.join('?' * len(batch))})",
+                batch,
+            )
+            for uuid, status, reason, attempts, retry_after, info in cursor:
+                rows[uuid] = {"status": status, "reason": reason, "attempts": attempts, "retry_after": retry_after,
+                              "info": json_io.loads(info) if info else None}
+        return rows
+
+    def is_due(self, row: dict, now: float = None) -> bool:
+        """Whether an image with this ledger row should be downloaded (again)."""
+        if row["status"] != "failed":
+            return False
+        return row["attempts"] < self.max_attempts and (now or time.time()) >= (row["retry_after"] or 0)
+
+    def record(self, uuid: str, url: str, source: str, outcome: dict, info: dict = None) -> None:
+        """
+        Buffer the outcome of one download attempt.
+        Args:
+        - outcome: dict, "status" is "ok" or the reason of the rejection, "http_status", "bytes" and "latency" may be None
+        - info: dict, optional, metadata of a downloaded image, returned by `lookup` on the next run
+        """
+        reason = outcome["status"]
+        if reason == "ok":
+            status, reason = "ok", None
+        elif reason in PERMANENT_REASONS:
+            status = "rejected"
+        else:
+            status = "failed"
+        now = time.time()
+        self.pending.append((uuid, url, source, status, reason, outcome.get("http_status"), outcome.get("bytes"),
+                             outcome.get("latency"), now, now + self.backoff if status == "failed" else None,
+                             json_io.dumps(info) if info is not None else None, self.backoff))
+        if len(self.pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany(
+                "INSERT INTO downloads (uuid, url, source, status, reason, http_status, bytes, latency, attempts, finished, retry_after, info) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?, ?) "
+                "ON CONFLICT(uuid) DO UPDATE SET url = excluded.url, source = excluded.source, status = excluded.status, "
+                "reason = excluded.reason, http_status = excluded.http_status, bytes = excluded.bytes, "
+                "latency = excluded.latency, attempts = attempts + 1, finished = excluded.finished, info = excluded.info, "
+                # the backoff doubles with every attempt
+                "retry_after = CASE WHEN excluded.status = 'failed' THEN excluded.finished + ? * (1 << MIN(attempts, 20)) END",
+                self.pending,
+            )
+        self.pending = []
+
+    def summary(self, source: str = None) -> dict:
+        """
+        Counts per status and reason, bytes and latency of the recorded downloads, of all of them or of one
+        match file `source`. There is no throughput: downloads are recorded when their shard closes and runs
+        of the same ledger may be days apart, see the timing printed by each run instead.
+        """
+        self.flush()
+        where, params = ("WHERE source = ?", (source,)) if source is not None else ("", ())
+        summary = dict.fromkeys(STATUSES, 0)
+        summary.update(self.conn.execute(f"SELECT status, COUNT(*) FROM downloads {where} GROUP BY status", params).fetchall())
+        summary["reasons"] = dict(self.conn.execute(
+            f"SELECT reason, COUNT(*) FROM downloads {where} {'AND' if where else 'WHERE'} reason IS NOT NULL "
+            "GROUP BY reason ORDER BY COUNT(*) DESC", params).fetchall())
+        total_bytes, avg_latency = self.conn.execute(
+            f"SELECT SUM(bytes), AVG(latency) FROM downloads {where} {'AND' if where else 'WHERE'} status = 'ok'", params).fetchone()
+        summary["bytes"] = total_bytes or 0
+        summary["avg_latency"] = avg_latency
+        return summary
+
+    def close(self) -> None:
+        self.flush()
+        self.conn.close()
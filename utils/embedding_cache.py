@@ -0,0 +1,105 @@
+import os
+import re
+import glob
+import time
+import hashlib
+
+import numpy as np
+
+
+def uuid_keys(uuids: list[str]) -> np.ndarray:
+    """A compact sortable 16 byte key of every uuid."""
+    return np.array([hashlib.blake2b(uuid.encode(), digest_size=16).digest() for uuid in uuids], dtype="S16")
+
+
+class EmbeddingCache(object):
+    """
+    Image embeddings on disk keyed by uuid, in one folder per model. Embeddings are stored L2-normalized as fp16
+    in append-only parts, `<part>.npy` with the uuids of its rows in `<part>.keys.npy`. The parts are memory mapped,
+    so a lookup only reads the rows it returns. A part is complete once its keys file exists, several processes
+    may add to the same cache.
+    """
+
+    def __init__(self, folder: str, model_name: str, flush_size: int = 1 << 16):
+        """
+        Args:
+        - folder: str, root folder of the cache
+        - model_name: str, name of the model that computed the embeddings, e.g. "ViT-B/32"
+        - flush_size: int, embeddings buffered before they are written as a new part
+        """
+        self.folder = os.path.join(folder, re.sub(r"[^\w.-]", "_", model_name))
+        os.makedirs(self.folder, exist_ok=True)
+        self.flush_size = flush_size
+        self.parts = []
+        self.part_keys = []
+        for keys_path in sorted(glob.glob(os.path.join(self.folder, "*.keys.npy"))):
+            self.part_keys.append(np.load(keys_path))
+            self.parts.append(np.load(f"{keys_path[:-len('.keys.npy')]}.npy", mmap_mode="r"))
+        self.pending_keys = []
+        self.pending = []
+        self.num_written = 0
+        self._index()
+
+    def _index(self):
+        self.indexed_parts = len(self.part_keys)
+        if not self.part_keys:
+            self.sorted_keys = np.zeros(0, dtype="S16")
+            return
+        keys = np.concatenate(self.part_keys)
+        order = np.argsort(keys, kind="stable")
+        self.sorted_keys = keys[order]
+        self.sorted_parts = np.repeat(np.arange(len(self.part_keys)), [len(keys) for keys in self.part_keys])[order]
+        self.sorted_rows = np.concatenate([np.arange(len(keys)) for keys in self.part_keys])[order]
+
+    def __len__(self) -> int:
+        return sum(len(keys) for keys in self.part_keys) + len(self.pending_keys)
+
+    @property
+    def dim(self) -> int:
+        return self.parts[0].shape[1]
+
+    def lookup(self, uuids: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        """Returns a mask of the uuids found in the cache and their embeddings as float32, in the order of `uuids`."""
+        self.flush()
+        if self.indexed_parts != len(self.part_keys):
+            self._index()
+        if len(uuids) == 0 or len(self.sorted_keys) == 0:
+            return np.zeros(len(uuids), dtype=bool), np.zeros((0, self.dim if self.parts else 0), dtype=np.float32)
+        keys = uuid_keys(uuids)
+        positions = np.minimum(np.searchsorted(self.sorted_keys, keys), len(self.sorted_keys) - 1)
+        found = self.sorted_keys[positions] == keys
+        parts = self.sorted_parts[positions[found]]
+        rows = self.sorted_rows[positions[found]]
+        embeddings = np.empty((len(rows), self.dim), dtype=np.float32)
+        for part in np.unique(parts):
+            selected = parts == part
+            embeddings[selected] = self.parts[part][rows[selected]]
+        return found, embeddings
+
+    def add(self, uuids: list[str], embeddings: np.ndarray) -> None:
+        """Buffer the normalized embeddings of `uuids`."""
+        self.pending_keys.extend(uuids)
+        self.pending.append(np.asarray(embeddings, dtype=np.float16))
+        if len(self.pending_keys) >= self.flush_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.pending_keys:
+            return
+        name = f"{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}-{self.num_written:06d}"
+        path = os.path.join(self.folder, name)
+        keys = uuid_keys(self.pending_keys)
+        embeddings = np.concatenate(self.pending)
+        # the keys are written last, a part without them is incomplete and ignored
+        for data, part_path in ((embeddings, f"{path}.npy"), (keys, f"{path}.keys.npy")):
+            with open(f"{part_path}.tmp", "wb") as f:
+                np.save(f, data)
+            os.replace(f"{part_path}.tmp", part_path)
+        self.part_keys.append(keys)
+        self.parts.append(np.load(f"{path}.npy", mmap_mode="r"))
+        self.num_written += 1
+        self.pending_keys = []
+        self.pending = []
+
+    def close(self) -> None:
+        self.flush()
@@ -0,0 +1,171 @@
+import io
+import math
+import itertools
+
+import numpy as np
+
+
+HASH_METHODS = ["phash", "dhash"]
+# grayscale size an image is shrunk to, (width, height), before it is hashed
+HASH_INPUT_SIZES = {"phash": (32, 32), "dhash": (9, 8)}
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def load_gray(source, method: str = "phash") -> np.ndarray:
+    """
+    Grayscale pixels of an image, path or bytes, shrunk to the input size of `method`.
+    JPEGs are decoded at a reduced scale with `draft`, the hash only needs a thumbnail.
+    """
+    from PIL import Image
+    size = HASH_INPUT_SIZES[method]
+    with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as image:
+        if image.format == "JPEG":
+            image.draft("L", (size[0] * 2, size[1] * 2))
+        return np.asarray(image.convert("L").resize(size, Image.LANCZOS), dtype=np.float32)
+
+
+def _pack_bits(bits: np.ndarray) -> np.ndarray:
+    """(N, 64) booleans to N uint64, the first bit being the most significant one."""
+    return np.packbits(bits.reshape(len(bits), 64), axis=1).view(">u8").ravel().astype(np.uint64)
+
+
+def _dct_matrix(size: int) -> np.ndarray:
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    return np.cos(np.pi * (2 * n + 1) * k / (2 * size)).astype(np.float32)
+
+
+_DCT32 = _dct_matrix(32)
+
+
+def phash(pixels: np.ndarray) -> np.ndarray:
+    """
+    Perceptual hashes of a batch of 32x32 grayscale images, shape (N, 32, 32): the sign of the lowest 8x8
+    frequencies of their 2d DCT against the median, robust to rescaling, recompression and small color changes.
+    """
+    coefficients = _DCT32 @ pixels @ _DCT32.T
+    low = coefficients[:, :8, :8].reshape(len(pixels), 64)
+    return _pack_bits(low > np.median(low, axis=1, keepdims=True))
+
+
+def dhash(pixels: np.ndarray) -> np.ndarray:
+    """Difference hashes of a batch of 9x8 grayscale images, shape (N, 8, 9): whether each pixel is brighter than its left neighbour."""
+    return _pack_bits(pixels[:, :, 1:] > pixels[:, :, :-1])
+
+
+def hash_pixels(pixels: np.ndarray, method: str = "phash") -> np.ndarray:
+    if method not in HASH_METHODS:
+        raise ValueError(f"unknown hash method {method}, expected one of {HASH_METHODS}")
+    if len(pixels) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    return phash(pixels) if method == "phash" else dhash(pixels)
+
+
+def popcount(values: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return _POPCOUNT8[values.view(np.uint8)].reshape(len(values), 8).sum(axis=1)
+
+
+def _chunk_plan(num_hashes: int, max_distance: int) -> tuple[int, int]:
+    """
+    Number of chunks and the distance searched within each chunk for multi-index hashing: two hashes within
+    `max_distance` bits have at least one of `m` chunks within `max_distance // m` bits. Few long chunks need
+    many bit flips per lookup, many short ones match many unrelated hashes, pick the cheapest of the two.
+    """
+    def cost(num_chunks):
+        bits = 64 // num_chunks
+        flips = sum(math.comb(bits, k) for k in range(max_distance // num_chunks + 1))
+        return num_chunks * flips * (num_hashes + num_hashes ** 2 / 2 ** bits)
+    num_chunks = min(range(1, max_distance + 2), key=cost)
+    return num_chunks, max_distance // num_chunks
+
+
+def _join(order: np.ndarray, sorted_keys: np.ndarray, flip: int, block_size: int = 1 << 20):
+    """Yield index pairs (i, j), i < j, whose keys differ by exactly `flip`."""
+    for start in range(0, len(sorted_keys), block_size):
+        # looked up in key order, so the binary searches walk the sorted keys front to back
+        positions = np.arange(start, min(start + block_size, len(sorted_keys)))
+        target = sorted_keys[positions] ^ sorted_keys.dtype.type(flip)
+        lo = np.searchsorted(sorted_keys, target, side="left")
+        hi = np.searchsorted(sorted_keys, target, side="right")
+        counts = hi - lo
+        total = counts.sum()
+        if total == 0:
+            continue
+        i = order[np.repeat(positions, counts)]
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        j = order[np.repeat(lo, counts) + offsets]
+        keep = i < j
+        yield i[keep], j[keep]
+
+
+def near_pairs(hashes: np.ndarray, max_distance: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    All index pairs (i, j), i < j, of distinct hashes within `max_distance` bits, found with multi-index hashing:
+    the hashes are split into chunks, candidates share a chunk up to a few flipped bits, found by binary search
+    in the sorted chunk values, and are then checked with their full Hamming distance.
+    """
+    num_chunks, chunk_distance = _chunk_plan(len(hashes), max_distance)
+    bounds = np.linspace(0, 64, num_chunks + 1).astype(int)
+    pairs_i, pairs_j = [], []
+    for low_bit, high_bit in zip(bounds[:-1], bounds[1:]):
+        bits = int(high_bit - low_bit)
+        keys = ((hashes >> np.uint64(low_bit)) & np.uint64((1 << bits) - 1)).astype(np.uint32 if bits <= 32 else np.uint64)
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        for num_flips in range(chunk_distance + 1):
+            for flipped in itertools.combinations(range(bits), num_flips):
+                flip = sum(1 << bit for bit in flipped)
+                for i, j in _join(order, sorted_keys, flip):
+                    close = popcount(hashes[i] ^ hashes[j]) <= max_distance
+                    pairs_i.append(i[close])
+                    pairs_j.append(j[close])
+    if not pairs_i:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+
+def connected_components(num_nodes: int, pairs_i: np.ndarray, pairs_j: np.ndarray) -> np.ndarray:
+    """Component of every node as the smallest node in it, by min-label propagation with pointer jumping."""
+    labels = np.arange(num_nodes)
+    if len(pairs_i) == 0:
+        return labels
+    while True:
+        low = np.minimum(labels[pairs_i], labels[pairs_j])
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, pairs_i, low)
+        np.minimum.at(new_labels, pairs_j, low)
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            return labels
+        labels = new_labels
+
+
+def find_near_duplicates(hashes: np.ndarray, max_distance: int = 4, priority: np.ndarray = None) -> np.ndarray:
+    """
+    Group hashes that are within `max_distance` bits of each other, directly or through a chain of others,
+    and return for every hash the index of the one kept from its group, itself for images without duplicates.
+    Args:
+    - hashes: np.ndarray, uint64 image hashes
+    - max_distance: int, largest Hamming distance of near-duplicates
+    - priority: np.ndarray, optional, the hash with the highest priority is kept from each group, e.g. the number
+      of pixels, ties and the default keep the first one
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    if len(hashes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    # exact copies are collapsed first, they are the bulk of the duplicates
+    unique, inverse = np.unique(hashes, return_inverse=True)
+    if max_distance > 0 and len(unique) > 1:
+        labels = connected_components(len(unique), *near_pairs(unique, max_distance))
+    else:
+        labels = np.arange(len(unique))
+    groups = labels[inverse.ravel()]
+    priority = np.zeros(len(hashes)) if priority is None else np.asarray(priority, dtype=np.float64)
+    order = np.lexsort((np.arange(len(hashes)), -priority, groups))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = groups[order][1:] != groups[order][:-1]
+    kept = np.empty(len(unique), dtype=np.int64)
+    kept[groups[order][first]] = order[first]
+    return kept[groups]
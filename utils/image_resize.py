@@ -0,0 +1,66 @@
+import io
+
+from .image_validation import InvalidImage
+
+
+ENCODE_FORMATS = ["jpeg", "webp"]
+
+
+class ImageResizer(object):
+    """
+    Shrinks a downloaded image to at most `max_side` pixels on its longer side and re-encodes it.
+    JPEGs are decoded at a reduced scale with `draft`, which skips most of the decoding work of large photos.
+    Instances are picklable and meant to run in a process pool.
+    """
+
+    def __init__(self, max_side: int = 512, encode_format: str = "jpeg", quality: int = 90):
+        """
+        Args:
+        - max_side: int, longer side of the stored images
+        - encode_format: str, one of `ENCODE_FORMATS`
+        - quality: int, encoder quality from 1 to 100
+        """
+        if encode_format not in ENCODE_FORMATS:
+            raise ValueError(f"unknown encode format {encode_format}, expected one of {ENCODE_FORMATS}")
+        self.max_side = max_side
+        self.encode_format = encode_format
+        self.quality = quality
+
+    def __call__(self, data: bytes, info: dict) -> tuple[bytes, dict]:
+        """Returns the new image bytes and `info` with the new format, size and dimensions, the original ones prefixed by `orig_`."""
+        from PIL import Image
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                orig_format, orig_size = image.format.lower(), image.size
+                if max(orig_size) <= self.max_side and orig_format == self.encode_format:
+                    # small enough already, re-encoding would only lose quality
+                    return data, self._info(info, data, orig_format, orig_size, data, orig_format, orig_size)
+                if image.format == "JPEG":
+                    image.draft("RGB", (self.max_side, self.max_side))
+                image = self._to_rgb(image)
+                image.thumbnail((self.max_side, self.max_side), Image.BICUBIC)
+                buffer = io.BytesIO()
+                image.save(buffer, format=self.encode_format.upper(), quality=self.quality)
+        except Exception:
+            raise InvalidImage("decode") from None
+        resized = buffer.getvalue()
+        return resized, self._info(info, data, orig_format, orig_size, resized, self.encode_format, image.size)
+
+    def _to_rgb(self, image):
+        from PIL import Image
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            if self.encode_format == "webp":
+                return image.convert("RGBA")
+            # jpeg has no alpha channel, flatten onto white
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            return background
+        return image.convert("RGB")
+
+    @staticmethod
+    def _info(info, data, orig_format, orig_size, new_data, new_format, new_size):
+        return {**info,
+                "format": new_format, "width": new_size[0], "height": new_size[1], "bytes": len(new_data),
+                "orig_format": orig_format, "orig_width": orig_size[0], "orig_height": orig_size[1],
+                "orig_bytes": len(data)}
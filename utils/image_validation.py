@@ -0,0 +1,136 @@
+import io
+import os
+from urllib.parse import urlparse
+
+
+IMAGE_FORMATS = ["jpeg", "png", "gif", "webp", "bmp", "tiff"]
+# file extension of the images of each format
+FORMAT_EXTENSIONS = {"jpeg": ".jpg", "png": ".png", "gif": ".gif", "webp": ".webp", "bmp": ".bmp", "tiff": ".tif"}
+# content types that are never an image, servers answer with them for error and login pages
+REJECTED_CONTENT_TYPES = ("text/", "application/json", "application/xml", "application/xhtml", "image/svg")
+
+
+def sniff_format(head: bytes) -> str:
+    """Image format told from the magic bytes at the start of a file, None when it is not a known image."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head.startswith(b"BM"):
+        return "bmp"
+    if head.startswith((b"II*\x00", b"MM\x00*")):
+        return "tiff"
+    if head[4:8] == b"ftyp" and head[8:12] in (b"avif", b"avis"):
+        return "avif"
+    if head[4:8] == b"ftyp" and head[8:12] in (b"heic", b"heix", b"mif1", b"msf1"):
+        return "heic"
+    return None
+
+
+def extract_extension(url: str) -> str:
+    """Extension of the path of `url`, .jpg when it has none."""
+    return os.path.splitext(urlparse(url).path)[1] or ".jpg"
+
+
+def image_file_name(item: dict, ext: str = None) -> str:
+    """
+    File name of the downloaded image of an item: the `image` recorded in its metadata, else the name
+    download_cc_images.py saves it under, the uuid with `ext` or the extension of its url.
+    """
+    return item.get("image") or f"{item['uuid']}{ext or extract_extension(item['url'])}"
+
+
+class InvalidImage(Exception):
+    """A download that must not be kept, the message is a short reason used in the download stats."""
+
+
+class ImageValidator(object):
+    """
+    Checks a download while it streams in: the response headers before the body is read, the magic bytes
+    and the image header from the first chunks, the size as it grows and, optionally, a full decode at the end.
+    """
+
+    def __init__(self,
+                 max_bytes: int = 20 * 2 ** 20,
+                 max_pixels: int = 50000000,
+                 formats: list[str] = None,
+                 verify_decode: bool = False,
+                 head_bytes: int = 1 << 16):
+        """
+        Args:
+        - max_bytes: int, larger downloads are aborted
+        - max_pixels: int, images with more pixels are rejected from their header
+        - formats: list[str], accepted formats out of the names `sniff_format` returns, defaults to `IMAGE_FORMATS`
+        - verify_decode: bool, decode every image once, catches truncated and corrupt files
+        - head_bytes: int, bytes buffered at most to read the image header, e.g. jpegs with large exif blocks
+        """
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.formats = set(formats or IMAGE_FORMATS)
+        self.verify_decode = verify_decode
+        self.head_bytes = head_bytes
+
+    def check_headers(self, content_type: str = None, content_length: int = None) -> None:
+        """Reject a response from its http headers, before any of the body is downloaded."""
+        if content_type and content_type.lower().startswith(REJECTED_CONTENT_TYPES):
+            raise InvalidImage("content type")
+        if content_length is not None and content_length > self.max_bytes:
+            raise InvalidImage("too large")
+
+    def check_size(self, num_bytes: int) -> None:
+        if num_bytes > self.max_bytes:
+            raise InvalidImage("too large")
+
+    def check_head(self, head: bytes, complete: bool = False) -> dict:
+        """
+        Format and dimensions from the first bytes of a file, None when more bytes are needed to tell.
+        `complete` means `head` is the whole file.
+        """
+        if len(head) < 12 and not complete:
+            return None
+        image_format = sniff_format(head)
+        if image_format is None:
+            raise InvalidImage("not an image")
+        if image_format not in self.formats:
+            raise InvalidImage("format")
+        from PIL import Image
+        try:
+            with Image.open(io.BytesIO(head)) as image:
+                width, height = image.size
+        except Image.DecompressionBombError:
+            raise InvalidImage("too many pixels") from None
+        except Exception:
+            if not complete and len(head) < self.head_bytes:
+                return None
+            raise InvalidImage("bad header") from None
+        if width * height > self.max_pixels:
+            raise InvalidImage("too many pixels")
+        return {"format": image_format, "width": width, "height": height}
+
+    def check_decode(self, source) -> None:
+        """Decode a whole image file, path or file object, jpegs at a reduced scale which still reads all of their data."""
+        if not self.verify_decode:
+            return
+        from PIL import Image
+        try:
+            with Image.open(source) as image:
+                if image.format == "JPEG":
+                    image.draft("RGB", (image.size[0] // 8 or 1, image.size[1] // 8 or 1))
+                image.load()
+        except Exception:
+            raise InvalidImage("decode") from None
+
+    def check_file(self, path: str) -> dict:
+        """Run every check on a file that is already on disk, e.g. downloaded by an earlier run."""
+        num_bytes = os.path.getsize(path)
+        self.check_size(num_bytes)
+        with open(path, "rb") as f:
+            head = f.read(self.head_bytes)
+        info = self.check_head(head, complete=num_bytes <= len(head))
+        self.check_decode(path)
+        info["bytes"] = num_bytes
+        return info
@@ -0,0 +1,140 @@
+"""
+Json (de)serialization shared by the query, download, filtering and aggregation scripts.
+Uses orjson (or simdjson for reading) when installed and falls back to the standard library.
+Output is compact utf-8 by default and parses to the same values whichever backend wrote it, though not
+byte for byte: floats may be formatted differently, e.g. orjson writes 1e16 and 0.000025 where json writes 1e+16 and 2.5e-05.
+Set `CC_JSON_BACKEND` to "orjson", "simdjson" or "json" to force a backend.
+"""
+import os
+import json
+from pathlib import Path
+
+
+JSON_BACKENDS = ["orjson", "simdjson", "json"]
+
+
+def _select_backend():
+    requested = os.environ.get("CC_JSON_BACKEND")
+    candidates = [requested] if requested else JSON_BACKENDS
+    for name in candidates:
+        if name not in JSON_BACKENDS:
+            raise ValueError(f"unknown json backend {name}, expected one of {JSON_BACKENDS}")
+        if name == "json":
+            return name, json
+        try:
+            return name, __import__(name)
+        except ImportError:
+            if requested:
+                raise
+    return "json", json
+
+
+JSON_BACKEND, _backend = _select_backend()
+
+
+def loads(data):
+    """
+    Parse a json document from str or bytes. Documents the faster backends reject, e.g. with lone surrogate escapes
+    that the standard library accepts, are parsed again with the standard library.
+    """
+    if JSON_BACKEND == "json":
+        return json.loads(data)
+    try:
+        return _backend.loads(data.encode() if JSON_BACKEND == "simdjson" and isinstance(data, str) else data)
+    except ValueError:
+        return json.loads(data)
+
+
+def load(fn):
+    with open(fn, "rb") as fr:
+        return loads(fr.read())
+
+
+def dumpb(obj, indent=None):
+    """
+    Serialize to utf-8 bytes, compact unless `indent` is given.
+    Strings that are not valid unicode, e.g. lone surrogates, are written as ascii escapes.
+    """
+    if JSON_BACKEND == "orjson" and indent in (None, 2):
+        try:
+            return _backend.dumps(obj, option=_backend.OPT_INDENT_2 if indent == 2 else 0)
+        except _backend.JSONEncodeError:
+            return _json_dumpb(obj, indent, ensure_ascii=True)
+    try:
+        return _json_dumpb(obj, indent)
+    except UnicodeEncodeError:
+        return _json_dumpb(obj, indent, ensure_ascii=True)
+
+
+def _json_dumpb(obj, indent=None, ensure_ascii=False):
+    separators = (",", ":") if indent is None else None
+    return json.dumps(obj, ensure_ascii=ensure_ascii, indent=indent, separators=separators).encode()
+
+
+def dumps(obj, indent=None):
+    return dumpb(obj, indent).decode()
+
+
+def dump(obj, fn, indent=None):
+    """Write `obj` to `<fn>.tmp` and rename it to `fn`, so `fn` only ever holds a complete document."""
+    Path(os.path.dirname(fn) or ".").mkdir(parents=True, exist_ok=True)
+    tmp_fn = f"{fn}.tmp"
+    try:
+        with open(tmp_fn, "wb") as fw:
+            fw.write(dumpb(obj, indent))
+    except BaseException:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+        raise
+    os.replace(tmp_fn, fn)
+
+
+class JsonArrayWriter(object):
+    """
+    Writes a json list one item at a time, the output is identical to `dump(items, fn, indent=indent)` with the same backend.
+    The list is written to `<fn>.tmp` and only renamed to `fn` when closed without error,
+    so a crash never leaves a partial output file behind.
+    """
+
+    def __init__(self, fn, indent=None):
+        Path(os.path.dirname(fn) or ".").mkdir(parents=True, exist_ok=True)
+        self.fn = fn
+        self.tmp_fn = f"{fn}.tmp"
+        self.indent = indent
+        self.count = 0
+        self.fw = open(self.tmp_fn, "wb")
+        self.fw.write(b"[")
+
+    def write(self, item):
+        text = dumpb(item, self.indent)
+        if self.indent is None:
+            self.fw.write(b"," + text if self.count else text)
+        else:
+            pad = b" " * self.indent
+            text = pad + text.replace(b"\n", b"\n" + pad)
+            self.fw.write(b",\n" + text if self.count else b"\n" + text)
+        self.count += 1
+
+    def write_all(self, items):
+        for item in items:
+            self.write(item)
+
+    def close(self):
+        if self.count and self.indent is not None:
+            self.fw.write(b"\n")
+        self.fw.write(b"]")
+        self.fw.close()
+        os.replace(self.tmp_fn, self.fn)
+
+    def abort(self):
+        self.fw.close()
+        os.remove(self.tmp_fn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+
+
+class LanguageIdentifier(object):
+    """
+    fasttext language identification that loads the model once, classifies texts in batches
+    and remembers the language of recent texts, since alt texts like "logo" repeat millions of times.
+    """
+
+    def __init__(self, cache_size: int = 100000, low_memory: bool = True):
+        """
+        Args:
+        - cache_size: int, number of normalized texts whose language is kept, least recently used first out
+        - low_memory: bool, use the compressed lid.176.ftz model
+        """
+        self.cache_size = cache_size
+        self.low_memory = low_memory
+        self.cache = OrderedDict()
+        self.model = None
+        self.num_predicted = 0
+        self.num_cached = 0
+
+    def _load(self):
+        import fasttext
+        fasttext.FastText.eprint = lambda x: None
+        from ftlangdetect.detect import get_or_load_model
+        self.model = get_or_load_model(low_memory=self.low_memory)
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        # fasttext rejects newlines, and texts differing only in spacing get the same label
+        return " ".join(text.split())
+
+    def predict(self, texts: list[str]) -> list[str]:
+        """Language codes (e.g. "en") of the texts, only texts missing from the cache reach the model."""
+        keys = [self.normalize(text) for text in texts]
+        missing = [key for key in dict.fromkeys(keys) if key not in self.cache]
+        self.num_cached += len(keys) - len(missing)
+        if missing:
+            if self.model is None:
+                self._load()
+            labels, _ = self.model.predict(missing, k=1)
+            self.num_predicted += len(missing)
+            for key, label in zip(missing, labels):
+                self.cache[key] = label[0].replace("__label__", "")
+        langs = []
+        for key in keys:
+            self.cache.move_to_end(key)
+            langs.append(self.cache[key])
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return langs
+
+
+language_identifier = None
+
+
+def get_language_identifier() -> LanguageIdentifier:
+    """The identifier of this process, created on first use so every worker loads the model once."""
+    global language_identifier
+    if language_identifier is None:
+        language_identifier = LanguageIdentifier()
+    return language_identifier
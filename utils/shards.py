@@ -0,0 +1,127 @@
+import io
+import os
+import glob
+import tarfile
+
+from . import json_io
+
+
+class ShardWriter(object):
+    """
+    Writes samples into tar shards in the WebDataset layout: the members of a sample are `<key>.<ext>`
+    next to each other, e.g. `<uuid>.jpg` and `<uuid>.json`. A shard is closed once it holds `max_count`
+    samples or `max_bytes` bytes. Next to every `<name>.tar` an index `<name>.idx.json` lists the byte
+    offset and size of each image, so single samples can be read without scanning the shard.
+    """
+
+    def __init__(self, folder: str, prefix: str, max_count: int = 10000, max_bytes: int = 1 << 30,
+                 resume: bool = False, on_close: callable = None):
+        """
+        Args:
+        - folder: str, folder of the shards
+        - prefix: str, shards are named `<prefix>-000000.tar`, `<prefix>-000001.tar`, ...
+        - max_count: int, samples per shard
+        - max_bytes: int, bytes per shard, a shard may exceed it by one sample
+        - resume: bool, number new shards after those of `prefix` already in `folder` instead of overwriting them
+        - on_close: callable, optional, `on_close(name)` is called once a shard is complete under its name
+        """
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.prefix = prefix
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.on_close = on_close
+        self.shard_index = -1
+        if resume:
+            existing = glob.glob(os.path.join(glob.escape(folder), f"{glob.escape(prefix)}-[0-9]*.tar"))
+            self.shard_index = max((int(path[:-4].rsplit("-", 1)[1]) for path in existing), default=-1)
+        self.tar = None
+        self.shard_names = []
+
+    def _open_next(self):
+        self.close()
+        self.shard_index += 1
+        self.name = f"{self.prefix}-{self.shard_index:06d}.tar"
+        self.path = os.path.join(self.folder, self.name)
+        # written to a temp file and renamed on close, a shard with its name is always complete
+        self.tar = tarfile.open(f"{self.path}.tmp", "w")
+        self.index = []
+
+    def _add_member(self, name: str, data: bytes) -> int:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        header_size = len(info.tobuf(self.tar.format, self.tar.encoding, self.tar.errors))
+        offset = self.tar.offset + header_size
+        self.tar.addfile(info, io.BytesIO(data))
+        return offset
+
+    def write(self, key: str, ext: str, data: bytes, meta: dict) -> str:
+        """Add the image `data` and its `meta` as sample `key`, returns the shard name it went to."""
+        if self.tar is None or len(self.index) >= self.max_count or self.tar.offset >= self.max_bytes:
+            self._open_next()
+        image_name = f"{key}{ext}"
+        offset = self._add_member(image_name, data)
+        self._add_member(f"{key}.json", json_io.dumpb(meta))
+        self.index.append({"key": key, "image": image_name, "offset": offset, "size": len(data)})
+        return self.name
+
+    def close(self) -> None:
+        if self.tar is None:
+            return
+        self.tar.close()
+        os.replace(f"{self.path}.tmp", self.path)
+        json_io.dump(self.index, shard_index_path(self.path))
+        self.shard_names.append(self.name)
+        self.tar = None
+        if self.on_close is not None:
+            self.on_close(self.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self.tar is not None:
+            self.tar.close()
+            os.remove(f"{self.path}.tmp")
+            self.tar = None
+
+
+def shard_index_path(shard_path: str) -> str:
+    return f"{os.path.splitext(shard_path)[0]}.idx.json"
+
+
+def list_shards(folder: str) -> list[str]:
+    return sorted(glob.glob(os.path.join(folder, "*.tar")))
+
+
+def iter_shard(shard_path: str):
+    """
+    Yield `(key, {ext: bytes})` for every sample of a shard, reading the tar front to back in one stream.
+    Members are grouped by the part of their name before the first dot.
+    """
+    key, sample = None, {}
+    with tarfile.open(shard_path, "r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            member_key, ext = member.name.split(".", 1) if "." in member.name else (member.name, "")
+            if member_key != key and sample:
+                yield key, sample
+                sample = {}
+            key = member_key
+            sample[f".{ext}"] = tar.extractfile(member).read()
+    if sample:
+        yield key, sample
+
+
+def read_sample(shard_path: str, offset: int, size: int) -> bytes:
+    """Bytes of one image at the offset recorded in the shard index."""
+    with open(shard_path, "rb") as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def load_shard_index(shard_path: str) -> list[dict]:
+    return json_io.load(shard_index_path(shard_path))
@@ -1,8 +1,23 @@
 ### Code adapted and modified from: https://github.com/facebookresearch/MetaCLIP/blob/main/metaclip/substr_matching.py ###
 # Copyright (c) Meta Platforms, Inc. and affiliates
 
+import os
+import mmap
+import pickle
+import hashlib
+from collections import deque
+
+from . import json_io
+
+
+MATCH_BACKENDS = ["auto", "ahocorasick", "python", "linear"]
+# bump when the pickled layout of `KeywordMatcher` changes, so stale cached indexes are rebuilt
+INDEX_VERSION = 2
+# characters that appear verbatim in a raw WAT json line whatever escaping the encoder applied
+PREFILTER_SAFE_CHARS = frozenset(chr(c) for c in range(0x21, 0x7F)) - frozenset("\"\\/<>&='")
+
+keyword_matcher = None
 
-spaced_metadata = None
 
 def spacing(text):
     puncts_to_wrap = [",", ".", ";", ":", "?", "!", "`"]
@@ -18,15 +33,271 @@ def spacing(text):
     return spaced_text
 
 
-def substr_matching(text, metadata):
-    global spaced_metadata
-    if spaced_metadata is None:
-        spaced_metadata = []
+def resolve_backend(backend):
+    if backend != "auto":
+        return backend
+    try:
+        import ahocorasick  # noqa: F401
+        return "ahocorasick"
+    except ImportError:
+        return "python"
+
+
+def _group_patterns(metadata):
+    # identical entries share one pattern but keep all of their ids
+    patterns = {}
+    for entry_id, entry in enumerate(metadata):
+        patterns.setdefault(f" {entry} ", []).append(entry_id)
+    return patterns
+
+
+class PythonAutomaton(object):
+    """Pure python Aho-Corasick automaton, used when `pyahocorasick` is not installed."""
+
+    def __init__(self, patterns):
+        """
+        Args:
+        - patterns: dict, maps a pattern string to the list of entry ids it stands for
+        """
+        goto = [{}]
+        out = [()]
+        for pattern, entry_ids in patterns.items():
+            state = 0
+            for ch in pattern:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][ch] = nxt
+                    goto.append({})
+                    out.append(())
+                state = nxt
+            out[state] = out[state] + tuple(entry_ids)
+
+        # breadth-first construction of the failure links
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in goto[state].items():
+                queue.append(nxt)
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0) if state else 0
+                if out[fail[nxt]]:
+                    out[nxt] = out[nxt] + out[fail[nxt]]
+
+        self.goto = goto
+        self.fail = fail
+        self.out = out
+
+    def find_all(self, text):
+        goto, fail, out = self.goto, self.fail, self.out
+        found = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+    def contains_any(self, text):
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                return True
+        return False
+
+
+def prefilter_token(entry):
+    """
+    Longest run of `PREFILTER_SAFE_CHARS` in an entry. A text that matches the entry always contains this run,
+    also inside a json line where non-ascii, quotes, slashes and html characters may be escaped.
+    Returns "" when the entry has no such run.
+    """
+    best, run = "", []
+    for ch in entry + " ":
+        if ch in PREFILTER_SAFE_CHARS:
+            run.append(ch)
+            continue
+        if len(run) > len(best):
+            best = "".join(run)
+        run = []
+    return best
+
+
+class KeywordPrefilter(object):
+    """
+    Cheap test whether a raw line may contain any keyword, used to skip records before `json.loads`.
+    It never rejects a line that `KeywordMatcher` would match; when some entry has no safe token
+    it cannot tell and lets every line through.
+    """
+
+    def __init__(self, metadata, backend="auto"):
+        tokens = set()
+        self.enabled = True
         for entry in metadata:
-            spaced_metadata.append(f" {entry} ")
-    text = spacing(text)
-    matched_entry_ids = []
-    for entry_id, entry in enumerate(spaced_metadata):
-        if entry in text:
-            matched_entry_ids.append(entry_id)
-    return matched_entry_ids
\ No newline at end of file
+            token = prefilter_token(entry)
+            if len(token) == 0:
+                self.enabled = False
+                break
+            tokens.add(token)
+        self.num_tokens = len(tokens)
+
+        backend = resolve_backend(backend)
+        self.backend = backend
+        if not self.enabled or backend == "linear":
+            self.tokens = sorted(tokens)
+        elif backend == "ahocorasick":
+            import ahocorasick
+            self.automaton = ahocorasick.Automaton()
+            for token in tokens:
+                self.automaton.add_word(token, token)
+            if len(self.automaton) > 0:
+                self.automaton.make_automaton()
+        else:
+            self.automaton = PythonAutomaton({token: [0] for token in tokens})
+
+    def contains_any(self, line):
+        if not self.enabled:
+            return True
+        if self.backend == "linear":
+            return any(token in line for token in self.tokens)
+        if self.backend == "ahocorasick":
+            if len(self.automaton) == 0:
+                return False
+            for _ in self.automaton.iter(line):
+                return True
+            return False
+        return self.automaton.contains_any(line)
+
+
+class KeywordMatcher(object):
+    """
+    Finds all token-bounded metadata entries in a text in a single pass.
+    A match has the same semantics as the original linear scan: the spaced entry ` {entry} `
+    is a substring of `spacing(text)`.
+    """
+
+    def __init__(self, metadata, backend="auto"):
+        """
+        Args:
+        - metadata: list[str], the keyword entries, entry ids are their positions in the list
+        - backend: str, one of `MATCH_BACKENDS`; "auto" uses `pyahocorasick` when installed and falls back
+          to the pure python automaton, "linear" keeps the original `entry in text` scan for parity checks
+        """
+        if backend not in MATCH_BACKENDS:
+            raise ValueError(f"unknown match backend {backend}, expected one of {MATCH_BACKENDS}")
+        self.requested_backend = backend
+        self.num_entries = len(metadata)
+
+        backend = resolve_backend(backend)
+        self.backend = backend
+
+        if backend == "linear":
+            self.spaced_metadata = [f" {entry} " for entry in metadata]
+        elif backend == "ahocorasick":
+            import ahocorasick
+            self.automaton = ahocorasick.Automaton()
+            for pattern, entry_ids in _group_patterns(metadata).items():
+                self.automaton.add_word(pattern, tuple(entry_ids))
+            if len(self.automaton) > 0:
+                self.automaton.make_automaton()
+        else:
+            self.automaton = PythonAutomaton(_group_patterns(metadata))
+        self.prefilter = KeywordPrefilter(metadata, backend=backend)
+
+    def match(self, text):
+        text = spacing(text)
+        if self.backend == "linear":
+            return [entry_id for entry_id, entry in enumerate(self.spaced_metadata) if entry in text]
+        if self.backend == "ahocorasick":
+            if len(self.automaton) == 0:
+                return []
+            found = set()
+            for _, entry_ids in self.automaton.iter(text):
+                found.update(entry_ids)
+        else:
+            found = self.automaton.find_all(text)
+        return sorted(found)
+
+    def save(self, path):
+        # write to a temp file first so concurrent readers never see a partial index
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        with open(tmp_path, "wb") as fw:
+            pickle.dump(self, fw, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        # unpickle straight from the page cache instead of copying the file into a python bytes object
+        with open(path, "rb") as fr:
+            with mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return pickle.loads(mm)
+
+
+def keyword_index_path(metadata_file, cache_dir, backend="auto"):
+    """
+    Path of the cached index for a keyword json. The name is derived from the content of the json,
+    the resolved backend and the index version, so editing the keywords invalidates the cache.
+    """
+    backend = resolve_backend(backend)
+    digest = hashlib.sha1()
+    with open(metadata_file, "rb") as fr:
+        for chunk in iter(lambda: fr.read(1 << 20), b""):
+            digest.update(chunk)
+    digest.update(f"{backend}:{INDEX_VERSION}".encode())
+    if backend == "ahocorasick":
+        import ahocorasick
+        digest.update(str(getattr(ahocorasick, "__version__", "")).encode())
+    stem = os.path.splitext(os.path.basename(metadata_file))[0]
+    return os.path.join(cache_dir, f"{stem}-{digest.hexdigest()[:16]}.{backend}.idx")
+
+
+def build_keyword_index(metadata_file, cache_dir, backend="auto"):
+    """
+    Compile the keyword json into a `KeywordMatcher` once and cache it on disk.
+    Returns the path of the index, which workers load with `load_keyword_index`.
+    """
+    index_path = keyword_index_path(metadata_file, cache_dir, backend)
+    if os.path.exists(index_path):
+        print(f"Using cached keyword index {index_path}")
+        return index_path
+    os.makedirs(cache_dir, exist_ok=True)
+    metadata = json_io.load(metadata_file)
+    print(f"Building keyword index for {len(metadata)} entries to {index_path}...")
+    KeywordMatcher(metadata, backend=backend).save(index_path)
+    return index_path
+
+
+def load_keyword_index(index_path, keep_prefilter=False):
+    """
+    Load a cached index as this process' matcher, meant to be used as a `Pool` initializer.
+    Returns the index' prefilter when `keep_prefilter` is set.
+    """
+    global keyword_matcher
+    keyword_matcher = KeywordMatcher.load(index_path)
+    # the prefilter is only used by the parser, do not keep it around in match workers
+    prefilter = keyword_matcher.prefilter if keep_prefilter else None
+    keyword_matcher.prefilter = None
+    return prefilter
+
+
+def load_keyword_prefilter(index_path):
+    return KeywordMatcher.load(index_path).prefilter
+
+
+def substr_matching(text, metadata=None, backend="auto"):
+    global keyword_matcher
+    if metadata is None:
+        # matcher was loaded from a cached index by `load_keyword_index`
+        return keyword_matcher.match(text)
+    if keyword_matcher is None or keyword_matcher.requested_backend != backend:
+        keyword_matcher = KeywordMatcher(metadata, backend=backend)
+    return keyword_matcher.match(text)
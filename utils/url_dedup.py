@@ -0,0 +1,187 @@
+import os
+import math
+import sqlite3
+import hashlib
+
+
+DEDUP_BACKENDS = ["memory", "bloom", "sqlite"]
+
+
+def text_key(uuid: str, text: str) -> int:
+    """Signed 64-bit hash of a (url uuid, text) pair, fits an sqlite INTEGER as is."""
+    data = f"{uuid}\x00{text}".encode("utf-8", "surrogatepass")
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little", signed=True)
+
+
+class HashDedupStore(object):
+    """
+    Exact dedup of one archive at a time with a set of 64-bit hashes instead of the texts themselves.
+    `begin` forgets the previous archive, like a new parser did before.
+    """
+
+    def __init__(self, max_items: int = None):
+        """
+        Args:
+        - max_items: int, optional, the set is cleared when it holds more hashes, bounding memory on huge archives
+        """
+        self.max_items = max_items
+        self.keys = set()
+
+    def begin(self, source: str) -> None:
+        self.keys = set()
+
+    def add(self, key: int) -> bool:
+        """True when the key was not seen before."""
+        if key in self.keys:
+            return False
+        if self.max_items is not None and len(self.keys) >= self.max_items:
+            print(f"Dedup store reached {self.max_items} keys, clearing it.")
+            self.keys = set()
+        self.keys.add(key)
+        return True
+
+    def flush(self) -> None:
+        pass
+
+    def clear(self) -> None:
+        self.keys = set()
+
+    def close(self) -> None:
+        self.keys = set()
+
+
+class BloomDedupStore(object):
+    """
+    Bloom filter over the 64-bit hashes that is kept for every archive of a process, so texts are deduped across archives
+    in a fixed amount of memory. A text is wrongly dropped as a duplicate with probability `error_rate`
+    as long as fewer than `capacity` texts were added.
+    """
+
+    def __init__(self, capacity: int = 20000000, error_rate: float = 0.01):
+        """
+        Args:
+        - capacity: int, number of texts the filter is sized for
+        - error_rate: float, false positive rate at `capacity` texts
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.num_items = 0
+        print(f"Bloom dedup filter of {len(self.bits) / 2 ** 20:.1f} MB with {self.num_hashes} hashes "
+              f"for {capacity} texts at a {error_rate} false positive rate.")
+
+    def begin(self, source: str) -> None:
+        if self.num_items > self.capacity:
+            print(f"Bloom dedup filter holds {self.num_items} texts, more than its capacity of {self.capacity}, "
+                  f"texts are dropped more often than {self.error_rate}.")
+
+    def add(self, key: int) -> bool:
+        """True when the key was not seen before, or False with probability `error_rate` for new keys."""
+        key &= 0xFFFFFFFFFFFFFFFF
+        # double hashing, the two halves of the key give all the bit positions
+        h1, h2 = key & 0xFFFFFFFF, (key >> 32) | 1
+        is_new = False
+        for i in range(self.num_hashes):
+            position = (h1 + i * h2) % self.num_bits
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                is_new = True
+        self.num_items += is_new
+        return is_new
+
+    def flush(self) -> None:
+        pass
+
+    def clear(self) -> None:
+        self.bits = bytearray(len(self.bits))
+        self.num_items = 0
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteDedupStore(object):
+    """
+    Hashes on disk, shared by all processes, nodes and runs that open the same database, for crawl-wide dedup.
+    Every hash remembers the archive that added it, so an archive that is processed again, e.g. after a failure,
+    keeps its own texts and only drops those first seen in other archives. Hashes are written in batches,
+    two archives processed at the same time may both keep a text neither had committed yet.
+    """
+
+    def __init__(self, path: str, flush_size: int = 10000):
+        """
+        Args:
+        - path: str, sqlite database file
+        - flush_size: int, new hashes buffered before they are written in one transaction
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.flush_size = flush_size
+        self.conn = sqlite3.connect(path, timeout=120, isolation_level=None)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS sources (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS seen (key INTEGER PRIMARY KEY, source INTEGER NOT NULL) WITHOUT ROWID")
+        self.source_id = None
+        self.source_keys = set()
+        self.pending = []
+
+    def begin(self, source: str) -> None:
+        """Start deduping the archive `source`, hashes are recorded under its name."""
+        self.flush()
+        self.conn.execute("INSERT OR IGNORE INTO sources (name) VALUES (?)", (source,))
+        self.source_id = self.conn.execute("SELECT id FROM sources WHERE name = ?", (source,)).fetchone()[0]
+        self.source_keys = set()
+
+    def add(self, key: int) -> bool:
+        """True when the key was not seen in this archive, nor committed by another one."""
+        if self.source_id is None:
+            raise RuntimeError("call begin(source) before adding keys")
+        if key in self.source_keys:
+            return False
+        row = self.conn.execute("SELECT source FROM seen WHERE key = ?", (key,)).fetchone()
+        if row is not None and row[0] != self.source_id:
+            return False
+        self.source_keys.add(key)
+        if row is None:
+            self.pending.append(key)
+            if len(self.pending) >= self.flush_size:
+                self.flush()
+        return True
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany("INSERT OR IGNORE INTO seen (key, source) VALUES (?, ?)",
+                                  [(key, self.source_id) for key in self.pending])
+        self.pending = []
+
+    def clear(self) -> None:
+        """Forget the keys of the current archive held in memory, the database is kept."""
+        self.flush()
+        self.source_keys = set()
+
+    def close(self) -> None:
+        self.flush()
+        self.conn.close()
+
+
+def open_dedup_store(backend: str = "memory", path: str = None, capacity: int = None, error_rate: float = 0.01):
+    """
+    Args:
+    - backend: str, "memory" dedups each archive exactly, "bloom" dedups all archives of a process in fixed memory,
+      "sqlite" dedups across processes, nodes and runs through the database at `path`
+    - capacity: int, optional, size of the bloom filter, or the maximum number of hashes held by the memory store
+    """
+    if backend == "memory":
+        return HashDedupStore(max_items=capacity)
+    if backend == "bloom":
+        return BloomDedupStore(capacity=capacity or 20000000, error_rate=error_rate)
+    if backend == "sqlite":
+        if path is None:
+            raise ValueError("the sqlite dedup store needs a database path")
+        return SqliteDedupStore(path)
+    raise ValueError(f"unknown dedup backend {backend}, expected one of {DEDUP_BACKENDS}")
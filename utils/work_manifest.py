@@ -0,0 +1,153 @@
+import os
+import time
+import socket
+import sqlite3
+import hashlib
+import threading
+import contextlib
+
+
+STATES = ["pending", "in_progress", "done", "failed"]
+
+
+def parse_shard(shard: str) -> tuple[int, int]:
+    """Parse "i/N" into (i, N), with 0 <= i < N."""
+    shard_index, num_shards = (int(part) for part in shard.split("/"))
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"invalid shard {shard}, expected i/N with 0 <= i < N")
+    return shard_index, num_shards
+
+
+def shard_uris(uris: list[str], shard_index: int, num_shards: int) -> list[str]:
+    """
+    Deterministic subset of the uris for one node. Assignment depends only on the file name,
+    so it does not change with the order of the listing or when files are added to it.
+    """
+    def shard_of(uri):
+        return int(hashlib.sha1(os.path.basename(uri).encode()).hexdigest()[:8], 16) % num_shards
+    return [uri for uri in uris if shard_of(uri) == shard_index]
+
+
+class WorkManifest(object):
+    """
+    SQLite manifest of the archives of a run, shared by all processes and nodes writing the same output folder.
+    Each archive is pending, in_progress (claimed by a node until its lease expires), done or failed,
+    with the node, attempts and timing recorded. Claiming is a single conditional UPDATE, so two nodes
+    never get the same archive, and archives of crashed nodes are picked up again once their lease runs out.
+    The database needs a filesystem with working locks, e.g. a local disk or a lock-capable network share.
+    """
+
+    def __init__(self, path: str, node: str = None, lease_seconds: float = 2 * 3600, max_attempts: int = 3):
+        """
+        Args:
+        - path: str, sqlite database file
+        - node: str, name recorded with claims, defaults to <hostname>:<pid>
+        - lease_seconds: float, time after which an in_progress archive may be claimed by another node
+        - max_attempts: int, failed archives are retried until they were attempted this many times
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.node = node or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.conn = sqlite3.connect(path, timeout=120, isolation_level=None)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS work ("
+            "uri TEXT PRIMARY KEY, state TEXT NOT NULL, node TEXT, attempts INTEGER NOT NULL DEFAULT 0, "
+            "started REAL, finished REAL, lease_expires REAL, elapsed REAL, error TEXT)"
+        )
+
+    def add(self, uris: list[str], done_uris: set = None) -> None:
+        """Register archives as pending, `done_uris` are registered as done. Known archives keep their state."""
+        done_uris = done_uris or set()
+        now = time.time()
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO work (uri, state, finished) VALUES (?, ?, ?)",
+                [(uri, "done", now) if uri in done_uris else (uri, "pending", None) for uri in uris],
+            )
+
+    def claim(self, uri: str) -> bool:
+        """Atomically take an archive for this node, returns False when it is done or held by another node."""
+        now = time.time()
+        cursor = self.conn.execute(
+            "UPDATE work SET state = 'in_progress', node = ?, started = ?, lease_expires = ?, "
+            "attempts = attempts + 1, error = NULL WHERE uri = ? AND ("
+            "state = 'pending' OR (state = 'failed' AND attempts < ?) OR "
+            "(state = 'in_progress' AND lease_expires < ?))",
+            (self.node, now, now + self.lease_seconds, uri, self.max_attempts, now),
+        )
+        return cursor.rowcount == 1
+
+    def renew(self, uris: list[str], conn: sqlite3.Connection = None) -> None:
+        """Extend the leases of archives this node is still working on."""
+        expires = time.time() + self.lease_seconds
+        (conn or self.conn).executemany(
+            "UPDATE work SET lease_expires = ? WHERE uri = ? AND node = ? AND state = 'in_progress'",
+            [(expires, uri, self.node) for uri in uris],
+        )
+
+    @contextlib.contextmanager
+    def heartbeat(self, uris: list[str], interval: float = 60):
+        """
+        Renew the leases of `uris` every `interval` seconds while the block runs, for archives processed
+        in one blocking call. The renewals run in a thread with its own connection.
+        """
+        stop = threading.Event()
+
+        def beat():
+            conn = sqlite3.connect(self.path, timeout=120, isolation_level=None)
+            try:
+                while not stop.wait(interval):
+                    try:
+                        self.renew(uris, conn)
+                    except sqlite3.Error as e:
+                        print(f"Failed to renew the leases of {uris}: {e}")
+            finally:
+                conn.close()
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, uri: str, elapsed: float = None) -> bool:
+        """Mark an archive of this node as done, returns False when its lease was lost and another node holds it."""
+        now = time.time()
+        cursor = self.conn.execute(
+            "UPDATE work SET state = 'done', finished = ?, elapsed = COALESCE(?, ? - started), error = NULL "
+            "WHERE uri = ? AND node = ? AND state = 'in_progress'",
+            (now, elapsed, now, uri, self.node),
+        )
+        return self._recorded(cursor, uri, "done")
+
+    def fail(self, uri: str, error: str) -> bool:
+        """Mark an archive of this node as failed, returns False when its lease was lost and another node holds it."""
+        now = time.time()
+        cursor = self.conn.execute(
+            "UPDATE work SET state = 'failed', finished = ?, elapsed = ? - started, error = ? "
+            "WHERE uri = ? AND node = ? AND state = 'in_progress'",
+            (now, now, str(error)[:2000], uri, self.node),
+        )
+        return self._recorded(cursor, uri, "failed")
+
+    def _recorded(self, cursor: sqlite3.Cursor, uri: str, state: str) -> bool:
+        if cursor.rowcount == 0:
+            # the lease expired and another node claimed the archive, its result is the one that counts
+            print(f"Not marking {uri} as {state}: {self.node} no longer holds it")
+            return False
+        return True
+
+    def summary(self) -> dict:
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(self.conn.execute("SELECT state, COUNT(*) FROM work GROUP BY state").fetchall())
+        avg_elapsed = self.conn.execute("SELECT AVG(elapsed) FROM work WHERE state = 'done' AND elapsed IS NOT NULL").fetchone()[0]
+        counts["avg_seconds_per_file"] = avg_elapsed
+        return counts
+
+    def close(self) -> None:
+        self.conn.close()